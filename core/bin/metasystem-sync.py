@@ -24,8 +24,37 @@
 #             Determines the direction(s) in which data is transferred.
 #             Not valid for 'type = unison' projects.
 #
+#             For 'type = rsync | unison' projects, a snapshot of the local
+#             tree is stored in ~/.sync-snapshots after each successful sync
+#             with each remote.  For rsync projects, it is taken before the
+#             push, so files which were pulled are pushed again by the next
+#             sync.  Push-only rsync projects whose local tree has not changed
+#             since the last sync with the same remote are skipped without
+#             contacting it.  Otherwise, only the paths which have changed are
+#             passed to rsync (via --files-from).  Use --force to transfer the
+#             whole tree.  Unison projects are always
+#             synchronised in full, since changes may have been made on the
+#             remote; their snapshots are only used by 'status'.
+#
 #         branches
-#             List of branches which are synchronised.
+#             List of branches which are synchronised.  All branches are
+#             fetched or pushed by a single git command; after fetching, local
+#             branches are fast-forwarded to the fetched refs.
+#             Only valid for 'type = git' projects.
+#
+#             Before git projects are synchronised, the refs on their remotes
+#             are listed via 'git ls-remote'.  Projects whose local branches
+#             (or, if branches is not set, whose current branch) already
+#             match the remote are skipped, and reported as being up to date.
+#             Use --force to synchronise them anyway.
+#
+#         clone_depth, clone_filter, reference
+#             Options passed to 'git clone' by 'init'.  clone_depth makes a
+#             shallow clone with that many commits of history.  clone_filter
+#             makes a partial clone; for example, 'blob:none' fetches the
+#             contents of files only when they are checked out.  reference
+#             names a local repository whose objects are borrowed rather than
+#             copied (see git-clone(1)), and is skipped if it does not exist.
 #             Only valid for 'type = git' projects.
 #
 #         subdirs
@@ -76,6 +105,160 @@
 #    [remote:my-gitorious]
 #    root = ssh://me@some.gitorious.server:22
 #    scm_bare = true
+#    max_jobs = 2
+#
+# For rsync projects, remotes may also specify
+#
+#    bandwidth = 2048
+#        Total bandwidth in KiB/s.  Each rsync project is passed, via
+#        --bwlimit, an equal share with the other rsync projects which are
+#        running on the remote when it starts (see --jobs and max_jobs).
+#
+#    compress = auto | true | false
+#        Whether rsync compresses data (-z).  This may be overridden by each
+#        rsync project.  With 'auto', the default, local copies are not
+#        compressed, and transfers over ssh are compressed unless the
+#        project's recent transfers, as recorded in the history database,
+#        achieved LAN-like throughput.
+#
+#    engine = rsync | native
+#        How files are transferred.  This may be overridden by each rsync
+#        project.  'native' copies files in-process, without running rsync,
+#        and is only valid for remotes whose root is a local path (such as a
+#        mounted network share).  Files are compared by size and mtime, and
+#        are copied via a temporary file which replaces the destination.
+#        Of rsync_options, only --delete, --checksum and --inplace are
+#        honoured; with --inplace, files which already exist at the
+#        destination are updated by rewriting only the blocks which differ.  As with rsync, special files
+#        (FIFOs, sockets and device nodes) are skipped with a warning.  See
+#        core/test/delta-benchmark.py for a comparison with rsync.
+#
+# For rsync and unison projects, remotes may also specify
+#
+#    lease_ttl = 300
+#        Take a lease on the remote copy of each project while it is being
+#        synchronised, so that two hosts do not synchronise it at the same
+#        time.  The lease is a directory next to the remote copy, which
+#        records the host holding it and when it expires (by the remote's
+#        clock).  The holder renews it every lease_ttl / 3 seconds; once it
+#        has expired, for example because the holder was killed, another host
+#        may take it over.  A host which finds the lease held waits for up to
+#        --lease-wait seconds (default 0) and otherwise skips the project.
+#        If the holder finds that it has lost the lease, the project is
+#        reported as failed.
+#        Leases are advisory: a host which does not use them is not stopped.
+#        0, the default, disables leases.
+#
+# A remote's git repositories may be cached in local bare mirrors:
+#
+#    [mirror:lan]
+#    remote = my-gitorious
+#    root = /srv/git-mirrors
+#    freshness = 600
+#
+# Git projects which use the remote then fetch (and 'init' clones) from the
+# mirror of their repository, root/<remote_path>.git, which is created on
+# first use.  Each mirror is fetched from the remote at most once per run,
+# and not at all if it was last fetched less than 'freshness' seconds ago
+# (default 300).  Pushes still go directly to the remote.  A mirror root may
+# be shared between hosts, for example on a LAN file server.
+#
+# Commands which fail transiently (for example because the connection to the
+# remote dropped) are retried up to 'retries' times, waiting 'retry_delay'
+# seconds before the first retry and twice as long before each subsequent
+# one.  A failure is transient if rsync or ssh exits with a network error, or
+# if git, hg or unison fail and the remote host cannot then be reached via
+# ssh.  After 'max_failures' consecutive transient failures on a remote
+# (0 disables this), projects which have not yet started on it are skipped.
+# The defaults are retries = 2, retry_delay = 2 and max_failures = 3.
+#
+# When projects are synchronised concurrently (see the --jobs option), at most
+# max_jobs projects which use a given remote are synchronised at once.
+#
+# For remotes which are accessed via ssh, a single master connection per host
+# is opened at the start of 'init' and 'sync', and is shared by all commands
+# run by those actions (see ssh_config(5), ControlMaster).  This can be
+# disabled with --no-multiplex.  git uses the master connection via GIT_SSH,
+# so not if GIT_SSH is already set, nor if GIT_SSH_COMMAND or core.sshCommand
+# are set, since git prefers them.
+#
+# 'init' clones projects concurrently, via the same scheduler as 'sync': up
+# to InitMaxJobs projects at once, or --jobs if that is larger, subject to
+# each remote's max_jobs.  With --reference DIR, each git project is seeded
+# from DIR/<remote_path> or DIR/<remote_path>.git, if either exists (for
+# example, a local mirror of the remote).  The objects which are borrowed
+# from it are then copied (git clone --dissociate), so the new clone does
+# not depend on DIR afterwards.
+#
+# With --metrics FILE, one JSON object per line is appended to FILE for each
+# phase of the run (config_parse, remote_connect, ref_check, history_write),
+# for each project synchronised (duration, and for rsync / unison projects the
+# bytes and files transferred), and for the run as a whole.  Records from one
+# run share a 'run' identifier.
+#
+# 'status' collects the state of all projects concurrently and prints it as a
+# table: the number of local changes, and the number of commits (git) or files
+# (rsync) which a sync would push and pull.  For unison projects, only local
+# changes since the last sync are counted.  With -v, the output of 'git diff'
+# is also shown for projects with local changes.
+#
+# 'verify' compares the contents of the local and remote copies of rsync and
+# unison projects by SHA-1 digest, and lists the files which differ or which
+# exist on only one side.  Digests are cached in ~/.sync-hashes, keyed on
+# each file's inode, size and mtime, so only files which have changed since
+# they were last hashed are read; delete ~/.sync-hashes to force every file
+# to be read.  On remotes accessed via ssh, files are listed by find(1) and
+# hashed by sha1sum(1), and their digests are cached locally.  The same
+# caches are used by rsync projects with engine = native and --checksum in
+# rsync_options.
+#
+# 'sync -n' does not run any project's dry-run command.  Instead, it works
+# out for all selected projects concurrently what a sync would transfer, and
+# prints one plan: the number of commits (git, hg) or files (rsync, unison)
+# which would be pushed and pulled, with an estimate of their size.  The
+# estimates come from 'git rev-list' against the refs listed by
+# 'git ls-remote', 'hg outgoing' / 'hg incoming', 'rsync --dry-run
+# --itemize-changes --stats', and the list of updates which unison prints
+# before asking whether to proceed.  Commits which have not been fetched, and
+# files which unison would pull over ssh, have no size estimate.  With -nn,
+# the commands which a sync would run are printed without being run.
+#
+# Project groups may also order the projects which they contain:
+#
+#    [project-group:mirrors]
+#    projects = upstream intermediate leaf docs
+#    requires = intermediate:upstream leaf:intermediate
+#    after = docs:upstream
+#
+# Each entry lists a project and, after the colon, the comma-separated
+# projects which must finish before it starts.  A project which 'requires'
+# another is skipped if that project fails (as is everything downstream of
+# it); a project which is 'after' another runs regardless.  Projects without
+# dependencies between them still run concurrently (see --jobs).
+#
+# 'sync --daemon' starts a daemon which watches the local trees of the
+# selected projects (via inotify if the pyinotify module is installed,
+# otherwise by polling) and synchronises each project once its tree has been
+# unchanged for --debounce seconds.  Every --reconcile seconds, all projects
+# are synchronised, to pick up changes made on remotes.  The configuration and
+# ssh connections are kept between runs, so the daemon must be restarted after
+# sync.ini is edited.  Output goes to ~/.sync-daemon.log (see --log); the
+# daemon is stopped by 'sync --stop-daemon'.
+#
+# With --format json, the result of each action (the configuration for
+# 'list', the history database for 'history', and per-project results and
+# timings for 'status', 'verify', 'init' and 'sync') is written to standard
+# output as a single JSON document.  All other output goes to standard error,
+# uncoloured.
+#
+# Sync runs are recorded in ~/.sync-history.db as each project completes.  If
+# a run is interrupted, 'sync --resume' with the same remote and projects
+# skips the projects which that run synchronised successfully with the same
+# remote.
+#
+# The parsed INI file is cached in ~/.sync-config-cache.  The cache is reused
+# until the INI file, the hostname or this script changes; --no-cache forces
+# the INI file to be parsed.
 #
 # See $METASYSTEM_CORE_CONFIG/sync.ini for an example INI file.
 
@@ -116,19 +299,54 @@ try:
 except ImportError:
     import ConfigParser as configparser
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import atexit
+from contextlib import contextmanager
 import copy
+import errno
+import fnmatch
 from datetime import timedelta
 from optparse import OptionParser
+import json
 import os.path
 import os
+import re
+import shlex
+import shutil
 import socket
+import sqlite3
 import subprocess
 import sys
-from time import time
+import tempfile
+import threading
+from time import sleep, time
+
+try:
+    from shlex import quote as ShellQuote
+except ImportError:
+    from pipes import quote as ShellQuote
 
 sys.path.append(os.path.join(sys.path[0], '../lib/python'))
 from metasystem import console
+from metasystem import delta
+from metasystem import hashcache
+from metasystem import snapshot
 from metasystem.console import Color
+from metasystem.threading import RepeatTimer
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
 #------------------------------------------------------------------------------
@@ -140,9 +358,79 @@ class Verbosity:
     Normal = 1
     Loud = 2
 
+class Status:
+    Failed = 0
+    Ok = 1
+    UpToDate = 2
+    Skipped = 3
+
+StatusNames = {
+    Status.Failed   : 'failed',
+    Status.Ok       : 'ok',
+    Status.UpToDate : 'up to date',
+    Status.Skipped  : 'skipped'
+}
+
 YellowThreshold = 60 * 60 * 24 * 7
 RedThreshold = YellowThreshold * 2
 
+RemoteMaxJobs = 4
+
+# Defaults for sync --daemon: the time (in seconds) for which a project's
+# local tree must be unchanged before it is synchronised, the interval between
+# synchronisations of all projects, and, if inotify is not available, the
+# interval between scans of the local trees
+DaemonDebounce = 5
+DaemonReconcileInterval = 15 * 60
+DaemonPollInterval = 10
+
+# Number of times a command which fails transiently is retried, the delay
+# before the first retry (which doubles for each subsequent one), and the
+# number of consecutive transient failures after which a remote is treated
+# as being down
+RemoteRetries = 2
+RemoteRetryDelay = 2
+RemoteMaxFailures = 3
+
+# Seconds for which a git mirror is used without being fetched again
+MirrorFreshness = 300
+
+# Seconds between attempts to take a remote lease which is held by another
+# host (see --lease-wait)
+LeasePollInterval = 10
+
+# With compress = auto, rsync transfers to a remote over ssh are compressed
+# unless recent transfers of the project achieved at least this throughput
+# (bytes/sec), measured over at least CompressionSampleBytes
+LanThroughput = 10 * 1024 * 1024
+CompressionSampleBytes = 16 * 1024 * 1024
+
+# Exit codes which indicate a transient failure.  For rsync, these are errors
+# in socket I/O or the protocol data stream, timeouts, and failure of ssh.
+TransientExitCodes = {
+    'rsync' : (10, 12, 30, 35, 255),
+    'ssh'   : (255,)
+}
+
+# Exit codes which may indicate a transient failure; the failure is treated as
+# transient if the remote host cannot be reached via ssh
+ProbeExitCodes = {
+    'git'    : 128,
+    'hg'     : 255,
+    'unison' : 3
+}
+
+# Number of projects whose status is collected concurrently
+StatusMaxJobs = 16
+
+# Minimum number of projects which are cloned concurrently by 'init'
+InitMaxJobs = 4
+
+# Incremented whenever the structure of the parsed configuration changes
+ConfigCacheVersion = 1
+
+HistoryTrendLength = 10
+
 LeftColumnWidth = 30
 Indent = 4
 
@@ -160,8 +448,185 @@ def check_env():
             raise IOError("Environment variable '{0:s}' not set".format(var))
 
 
+class OutputRouter:
+    # Stands in for sys.stdout.  Output written by a thread which has an
+    # output stream assigned via SetJobOutput goes to that stream (typically a
+    # per-project log file); all other output goes to the console.  If
+    # colour is False, the console is a plain stream.
+    def __init__(self, stream, colour = True):
+        self.stream = stream
+        self.colour = colour
+        self.local = threading.local()
+
+    def target(self):
+        stream = getattr(self.local, 'stream', None)
+        if stream:
+            return stream
+        return self.stream
+
+    def write(self, data):
+        self.target().write(data)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def SetJobOutput(stream):
+    sys.stdout.local.stream = stream
+
+
+def JobOutput():
+    return getattr(sys.stdout.local, 'stream', None)
+
+
+jobState = threading.local()
+
+
+def ResetJobState(remote = None, target = None):
+    # The remote and ssh target determine whether, and how often, failed
+    # commands are retried
+    jobState.remote = remote
+    jobState.target = target
+    jobState.exitCode = None
+    jobState.bytes = None
+    jobState.files = None
+    jobState.unrecordedBytes = None
+
+
+def LastExitCode():
+    # Exit code of the last command run by the current thread
+    return getattr(jobState, 'exitCode', None)
+
+
+def AddTransferStats(bytes, files):
+    # Accumulates the amount of data transferred by the current job
+    def _add(total, value):
+        if value is None:
+            return total
+        return (total or 0) + value
+    jobState.bytes = _add(getattr(jobState, 'bytes', None), bytes)
+    jobState.files = _add(getattr(jobState, 'files', None), files)
+    jobState.unrecordedBytes = _add(getattr(jobState, 'unrecordedBytes', None), bytes)
+
+
+def TakeUnrecordedBytes():
+    # Returns the number of bytes transferred by the current job since the
+    # last call
+    bytes = getattr(jobState, 'unrecordedBytes', None)
+    jobState.unrecordedBytes = None
+    return bytes
+
+
+def RsyncStatsValues(output):
+    # Returns a dictionary mapping each numeric field in the output of
+    # 'rsync --stats', such as 'Total bytes sent', to its value
+    values = { }
+    for line in output.splitlines():
+        match = re.match(r'\s*([A-Za-z ]+):\s*([\d,]+)', line)
+        if match:
+            values[match.group(1).strip()] = int(match.group(2).replace(',', ''))
+    return values
+
+
+def ParseRsyncStats(output):
+    # Parses the output of 'rsync --stats'.  Returns a (bytes, files) tuple,
+    # where bytes is the amount of data sent over the connection.
+    values = RsyncStatsValues(output)
+    bytes = None
+    if 'Total bytes sent' in values and 'Total bytes received' in values:
+        bytes = values['Total bytes sent'] + values['Total bytes received']
+    files = values.get('Number of regular files transferred',
+                       values.get('Number of files transferred'))
+    return (bytes, files)
+
+
+def ParseUnisonStats(output):
+    # Unison reports the number of items transferred, but not their size
+    match = re.search(r'\((\d+) items? transferred', output)
+    if match:
+        return (None, int(match.group(1)))
+    return (None, None)
+
+
+def UnisonPreview(args):
+    # Unison has no dry-run option.  Without -batch, it lists the updates
+    # which it would propagate and then asks whether to proceed; answering
+    # 'q' quits without propagating anything.  Returns the output, or None
+    # if unison could not be run.
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        return process.communicate('q\n')[0]
+    except OSError:
+        return None
+
+
+def ParseUnisonPlan(output):
+    # Parses the list of updates printed by unison before it asks whether to
+    # proceed.  Returns (push, pull, conflicts) lists of paths.
+    result = ([], [], [])
+    for line in output.splitlines():
+        match = re.match(r'.*?(---->|<----|<-\?->|<=\?=>|<-M->)\s*(.*)$', line)
+        if not match:
+            continue
+        # The path follows the description of the change on the remote side
+        path = re.sub(r'^(new (file|dir|link|symlink)|changed|deleted|props|unchanged)\s+',
+                      '', match.group(2).strip())
+        if not path:
+            continue
+        index = {'---->': 0, '<----': 1}.get(match.group(1), 2)
+        result[index].append(path)
+    return result
+
+
+def TreeSize(path):
+    # Total size of the files under path, or of path itself if it is a file
+    if os.path.islink(path) or not os.path.isdir(path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return 0
+    size = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            if not os.path.islink(filename):
+                size += os.path.getsize(filename)
+    return size
+
+
+def ReplaceFile(filename, content):
+    # Writes content to filename, unless it is already there, via a temporary
+    # file which is renamed over it, so that a concurrent reader sees either
+    # the old or the new content
+    try:
+        with open(filename, 'r') as f:
+            if f.read() == content:
+                return
+    except IOError:
+        pass
+    (fd, tmp) = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                                 dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+
+
 def PrintToConsole(message, color = None):
     #print "PRINT [%s] color %s" % (message, str(color))
+    if JobOutput() or not sys.stdout.colour:
+        # Log files are not coloured, and the console render state must not
+        # be touched from worker threads
+        sys.stdout.write(message)
+        return
     sys.stdout.state.push()
     sys.stdout.state.set_fg(color)
     sys.stdout.write(message)
@@ -176,22 +641,203 @@ def PrintWarning(message):
     PrintToConsole('Warning: ' + message + '\n')
 
 
-def Execute(command, options, flag = True):
+def Execute(command, options, flag = True, cwd = None):
     if Verbosity.Silent != options.verbosity:
+        if cwd and Verbosity.Loud == options.verbosity:
+            print('\n[' + cwd + ']', end='')
         print('\n' + command)
     success = True
     if flag:
         try:
-            r = subprocess.call(command.split())
-            if 0 != r:
+            output = JobOutput()
+            stderr = None
+            if output:
+                output.flush()
+                stderr = subprocess.STDOUT
+            attempt = 0
+            while True:
+                r = subprocess.call(shlex.split(command), stdout=output, stderr=stderr,
+                                    cwd=cwd)
+                jobState.exitCode = r
+                if 0 == r:
+                    break
                 PrintError("'" + command + "' failed with error " + str(r))
-                success = False
+                if not RetryFailedCommand(command, attempt):
+                    success = False
+                    break
+                attempt += 1
         except OSError as e:
             PrintError("'" + command + "' failed:")
             PrintError(str(e))
     return success
 
 
+def ExecuteCapture(command, options, flag = True, cwd = None, mergeStderr = False):
+    # As Execute, but the standard output of the command (and, if mergeStderr
+    # is set, its standard error) is also returned.  Output is echoed as it
+    # arrives.
+    if Verbosity.Silent != options.verbosity:
+        print('\n' + command)
+    success = True
+    output = ''
+    if flag:
+        try:
+            stderr = JobOutput()
+            if stderr:
+                stderr.flush()
+            if mergeStderr:
+                stderr = subprocess.STDOUT
+            attempt = 0
+            while True:
+                process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE,
+                                           stderr=stderr, cwd=cwd)
+                lines = []
+                for line in iter(process.stdout.readline, ''):
+                    lines.append(line)
+                    if Verbosity.Silent != options.verbosity:
+                        sys.stdout.write(line)
+                process.wait()
+                output = ''.join(lines)
+                jobState.exitCode = process.returncode
+                if 0 == process.returncode:
+                    break
+                PrintError("'" + command + "' failed with error " + str(process.returncode))
+                if not RetryFailedCommand(command, attempt):
+                    success = False
+                    break
+                attempt += 1
+        except OSError as e:
+            PrintError("'" + command + "' failed:")
+            PrintError(str(e))
+            success = False
+    return (success, output)
+
+
+def RetryFailedCommand(command, attempt):
+    # Called when a command run on behalf of a job fails.  If the failure is
+    # transient, waits and returns True to indicate that the command should
+    # be run again.  Once retries are exhausted, the failure counts towards
+    # the remote's circuit breaker.
+    remote = getattr(jobState, 'remote', None)
+    if not remote or not IsTransientFailure(command, LastExitCode(), jobState.target):
+        return False
+    if attempt < remote.retries and not circuitBreaker.isOpen(remote):
+        delay = remote.retry_delay * (2 ** attempt)
+        PrintWarning("Transient failure; retrying in " + str(delay) + " sec (retry " + \
+                     str(attempt + 1) + " of " + str(remote.retries) + ")")
+        sleep(delay)
+        return True
+    circuitBreaker.failure(remote)
+    return False
+
+
+def IsTransientFailure(command, exitCode, target):
+    program = os.path.basename(shlex.split(command)[0])
+    if exitCode in TransientExitCodes.get(program, ()):
+        return True
+    if target and exitCode == ProbeExitCodes.get(program):
+        return not SshReachable(target)
+    return False
+
+
+def SshArgs(target, options = []):
+    # Returns the arguments of an ssh command which connects to target,
+    # reusing the master connection to its host if there is one
+    (host, port) = target
+    args = ['ssh'] + options
+    if sshMux.command():
+        args += ['-o', 'ControlPath=' + sshMux.controlPath()]
+    if port:
+        args += ['-p', port]
+    return args + [host]
+
+
+def SshReachable(target):
+    args = SshArgs(target, ['-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10']) + ['true']
+    devnull = open(os.devnull, 'w')
+    try:
+        # ssh exits with 255 if it could not connect
+        return 255 != subprocess.call(args, stdout=devnull, stderr=devnull)
+    except OSError:
+        return False
+
+
+def QueryOutput(args, cwd = None, input = None, codes = [0]):
+    # Runs a command which only queries state, without printing anything.
+    # input, if given, is written to its standard input.  Returns its
+    # standard output, or None if it failed (exited with a code which is
+    # not in codes).
+    try:
+        stdin = None
+        if input is not None:
+            stdin = subprocess.PIPE
+        process = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE,
+                                   stderr=open(os.devnull, 'w'), cwd=cwd)
+        output = process.communicate(input)[0]
+        if process.returncode in codes:
+            return output
+    except OSError:
+        pass
+    return None
+
+
+def ParseFindTime(value):
+    # Converts a time printed by 'find -printf %T@', in seconds with a
+    # fractional part, to nanoseconds
+    (secs, dot, frac) = value.partition('.')
+    return int(secs) * 1000000000 + int((frac + '0' * 9)[:9])
+
+
+def ParseDigestLine(line):
+    # Returns the (path, digest) in a line of sha1sum output.  Paths which
+    # contain a newline or backslash are escaped, and the line starts with a
+    # backslash.
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    (digest, path) = line.split(' ', 1)
+    # The path is preceded by ' ' (text mode) or '*' (binary mode)
+    path = path[1:]
+    if escaped:
+        path = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), path)
+    return (path, digest)
+
+
+def RemoteDigests(target, path, cache):
+    # Returns a dict which maps the path of each file under path on a remote
+    # host to its digest.  Only files whose inode, size or mtime do not match
+    # the HashCache are read.  Raises IOError on failure.
+    args = SshArgs(target, ['-o', 'BatchMode=yes'])
+    cd = 'cd ' + ShellQuote(path) + ' && '
+    output = QueryOutput(args + [cd + "find . -type f -printf '%i %s %T@ %P\\0'"])
+    if output is None:
+        raise IOError("failed to list files under '" + path + "' on " + target[0])
+    keys = { }
+    for record in output.split('\0'):
+        if record:
+            (inode, size, mtime, name) = record.split(' ', 3)
+            keys[name] = (int(inode), int(size), ParseFindTime(mtime))
+    result = { }
+    stale = cache.stale(keys)
+    if stale:
+        command = cd + 'xargs -0 ' + cache.algorithm + 'sum --'
+        output = QueryOutput(args + [command], input='\0'.join(stale))
+        if output is None:
+            raise IOError("failed to hash files under '" + path + "' on " + target[0])
+        for line in output.splitlines():
+            (name, digest) = ParseDigestLine(line)
+            if name in keys:
+                cache.set(name, keys[name], digest)
+                result[name] = digest
+        cache.hashed += len(stale)
+        cache.hashed_bytes += sum([keys[name][1] for name in stale])
+    for name, key in keys.items():
+        if not name in result:
+            result[name] = cache.get(name, key)
+    cache.prune(keys.keys())
+    return result
+
+
 def FormatDuration(deltaSecs):
     if deltaSecs < 0:
         return "???"
@@ -264,6 +910,33 @@ class DurationTimer:
         return "\n" + self.operation + " completed in " + FormatDuration(time() - self.start)
 
 
+def ProcessExists(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # The process exists, but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def SshTarget(url):
+    # Returns a ([user@]host, port) tuple for a URL which is accessed via
+    # ssh, i.e. 'ssh://[user@]host[:port][/path]' or '[user@]host:path'.
+    # Returns None for local paths.
+    if url.startswith('ssh://'):
+        target = url[6:].split('/')[0]
+        port = None
+        if ':' in target:
+            (target, port) = target.rsplit(':', 1)
+        return (target, port)
+    index = url.find(':')
+    if index > 0 and not '/' in url[:index] and not '://' in url:
+        return (url[:index], None)
+    return None
+
+
 def FormatKeyValue(key, value, indent=0):
     num_dots = LeftColumnWidth - (len(key) + 2) - indent
     return (' ' * indent) + key + ' ' + ('.' * num_dots) + ' ' + value
@@ -295,17 +968,589 @@ class Local:
 #------------------------------------------------------------------------------
 
 class Remote:
-    def __init__(self, name, root, scm_bare):
+    def __init__(self, name, root, scm_bare, max_jobs = RemoteMaxJobs,
+                 retries = RemoteRetries, retry_delay = RemoteRetryDelay,
+                 max_failures = RemoteMaxFailures, bandwidth = 0, compress = 'auto',
+                 engine = 'rsync', lease_ttl = 0):
         self.name = name
         self.root = root
         self.scm_bare = scm_bare
+        self.max_jobs = max_jobs
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        # Total bandwidth, in KiB/s, shared by concurrent rsync transfers
+        # to this remote; 0 means unlimited
+        self.bandwidth = bandwidth
+        self.compress = compress
+        self.engine = engine
+        # Lifetime in seconds of leases on projects' remote copies; 0 means
+        # that leases are not used
+        self.lease_ttl = lease_ttl
 
     def __repr__(self):
         repr = "" + self.name
         repr += "\n" + FormatKeyValue('root', self.root, Indent)
         repr += "\n" + FormatKeyValue('scm_bare', str(self.scm_bare), Indent)
+        repr += "\n" + FormatKeyValue('max_jobs', str(self.max_jobs), Indent)
+        repr += "\n" + FormatKeyValue('retries', str(self.retries), Indent)
+        repr += "\n" + FormatKeyValue('retry_delay', str(self.retry_delay), Indent)
+        repr += "\n" + FormatKeyValue('max_failures', str(self.max_failures), Indent)
+        repr += "\n" + FormatKeyValue('bandwidth', str(self.bandwidth), Indent)
+        repr += "\n" + FormatKeyValue('compress', self.compress, Indent)
+        repr += "\n" + FormatKeyValue('engine', self.engine, Indent)
+        repr += "\n" + FormatKeyValue('lease_ttl', str(self.lease_ttl), Indent)
+        return repr
+
+
+#------------------------------------------------------------------------------
+# CircuitBreaker
+#------------------------------------------------------------------------------
+
+class CircuitBreaker:
+    # Counts consecutive transient failures for each remote host.  Once a
+    # remote has failed max_failures times in a row, it is treated as being
+    # down, and jobs which have not yet started on it are skipped.
+    def __init__(self):
+        self.failures = { }
+        self.lock = threading.Lock()
+
+    def failure(self, remote):
+        with self.lock:
+            self.failures[remote.root] = self.failures.get(remote.root, 0) + 1
+
+    def success(self, remote):
+        with self.lock:
+            self.failures[remote.root] = 0
+
+    def reset(self):
+        # Called at the start of each run by the daemon, so that a remote
+        # which was down is tried again
+        with self.lock:
+            self.failures = { }
+
+    def isOpen(self, remote):
+        return remote.max_failures > 0 and \
+               self.failures.get(remote.root, 0) >= remote.max_failures
+
+
+circuitBreaker = CircuitBreaker()
+
+
+#------------------------------------------------------------------------------
+# SshMultiplexer
+#------------------------------------------------------------------------------
+
+class SshMultiplexer:
+    # Opens one ssh master connection per remote host.  Commands which connect
+    # to those hosts reuse the master connection via the ControlPath option,
+    # which is passed to the other tools via their own ssh command options,
+    # and to git via a wrapper script named by GIT_SSH.  Since git prefers
+    # GIT_SSH_COMMAND and core.sshCommand to GIT_SSH, repositories which set
+    # their own ssh command keep using it.
+    def __init__(self):
+        self.dir = None
+        self.targets = []
+        # Set if GIT_SSH was set by start()
+        self.gitSsh = None
+        # If set, connections are kept open by release(), so that they can be
+        # reused by later runs in the same process
+        self.persistent = False
+
+    def controlPath(self):
+        # %C is a hash of the connection's parameters, so the socket path does
+        # not exceed the limit on the length of Unix socket paths
+        return os.path.join(self.dir, '%C')
+
+    def command(self):
+        # Returns the ssh command to be used by child processes, or None if
+        # no master connections are open
+        if not self.dir:
+            return None
+        return 'ssh -o ControlPath=' + self.controlPath()
+
+    def start(self, targets, options):
+        # Hosts to which a master connection is already open are skipped
+        targets = sorted(set(targets) - set(self.targets))
+        if not len(targets) or os.name == 'nt' or options.dry_run > 1:
+            return
+        if not self.dir:
+            self.dir = tempfile.mkdtemp(prefix='metasystem-ssh-')
+            atexit.register(self.stop)
+        processes = []
+        for (host, port) in targets:
+            args = self._args(host, port, ['-o', 'ControlMaster=yes',
+                                           '-o', 'ControlPersist=yes',
+                                           '-f', '-N'])
+            if Verbosity.Silent != options.verbosity:
+                print('\n' + ' '.join(args))
+            try:
+                processes.append((host, port, subprocess.Popen(args)))
+            except OSError as e:
+                PrintWarning("ssh connection to '" + host + "' failed: " + str(e))
+        # The masters are started concurrently; each forks into the
+        # background once it is connected
+        for (host, port, process) in processes:
+            if 0 == process.wait():
+                self.targets.append((host, port))
+            else:
+                PrintWarning("ssh connection to '" + host + "' failed")
+        self._setGitSsh()
+
+    def _setGitSsh(self):
+        # A GIT_SSH set by the user takes precedence
+        if self.gitSsh or os.environ.get('GIT_SSH'):
+            return
+        # git infers from the name 'ssh' that the program accepts OpenSSH
+        # options
+        self.gitSsh = os.path.join(self.dir, 'ssh')
+        with open(self.gitSsh, 'w') as f:
+            f.write('#!/bin/sh\nexec ' + self.command() + ' "$@"\n')
+        os.chmod(self.gitSsh, 0755)
+        os.environ['GIT_SSH'] = self.gitSsh
+
+    def release(self):
+        if not self.persistent:
+            self.stop()
+
+    def stop(self):
+        if not self.dir:
+            return
+        devnull = open(os.devnull, 'w')
+        for (host, port) in self.targets:
+            subprocess.call(self._args(host, port, ['-O', 'exit']),
+                            stdout=devnull, stderr=devnull)
+        self.targets = []
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir = None
+        if self.gitSsh:
+            os.environ.pop('GIT_SSH', None)
+            self.gitSsh = None
+
+    def _args(self, host, port, extra):
+        args = ['ssh', '-o', 'ControlPath=' + self.controlPath()] + extra
+        if port:
+            args += ['-p', port]
+        args.append(host)
+        return args
+
+
+sshMux = SshMultiplexer()
+
+
+#------------------------------------------------------------------------------
+# RefCache
+#------------------------------------------------------------------------------
+
+class RefCache:
+    # Holds the branch heads of remote git repositories, as listed by
+    # 'git ls-remote'.  The cache is filled before any project is
+    # synchronised, so that projects which are already up to date can be
+    # skipped.
+    def __init__(self):
+        self.refs = { }
+
+    def prefetch(self, projects, options, config):
+        # Repositories are listed concurrently across remote hosts, and one
+        # after another for each host, so that a host sees at most one
+        # connection from this pass.  Refs listed by a previous pass (in the
+        # daemon) are discarded, so that a repository which can no longer be
+        # listed is not compared against stale heads.
+        self.refs = { }
+        hosts = { }
+        for project in projects:
+            if isinstance(project, GitProject):
+                remote = project.getRemote(options, config)
+                url = project._remote_path(remote, options)
+                hosts.setdefault(remote.root, []).append(url)
+        threads = []
+        for urls in hosts.values():
+            thread = threading.Thread(target = self._list, args = (urls,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _list(self, urls):
+        for url in urls:
+            output = QueryOutput(['git', 'ls-remote', '--heads', url])
+            if output is not None:
+                self.refs[url] = ParseRefs(output)
+
+    def get(self, url):
+        # Returns a dictionary mapping branch names to commit IDs, or None if
+        # the repository could not be listed
+        return self.refs.get(url)
+
+
+def ParseRefs(output):
+    # Parses lines of the form '<sha> <refname>', as produced by
+    # 'git ls-remote' and 'git show-ref'
+    refs = { }
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].startswith('refs/heads/'):
+            refs[fields[1][11:]] = fields[0]
+    return refs
+
+
+refCache = RefCache()
+
+
+def GitMissingObjects(path, shas):
+    # Returns the set of object IDs which are not present in the repository
+    # at path
+    shas = list(set(shas))
+    if not shas:
+        return set()
+    output = QueryOutput(['git', 'cat-file', '--batch-check'], cwd=path,
+                         input='\n'.join(shas) + '\n')
+    if output is None:
+        return set(shas)
+    return set([line.split()[0] for line in output.splitlines()
+                if line.endswith(' missing')])
+
+
+def GitRevList(path, include, exclude, option):
+    # Runs 'git rev-list option', for the commits reachable from include but
+    # not from exclude.  Returns its output, or None if it failed.
+    return QueryOutput(['git', 'rev-list', option] + list(include) + ['--not'] + list(exclude),
+                       cwd=path)
+
+
+def GitObjectsSize(path, include, exclude):
+    # Estimates the amount of data in the objects reachable from include but
+    # not from exclude, from their size on disk.  Returns None on failure.
+    output = GitRevList(path, include, exclude, '--objects')
+    if output is None:
+        return None
+    objects = [line.split()[0] for line in output.splitlines() if line]
+    if not objects:
+        return 0
+    output = QueryOutput(['git', 'cat-file', '--batch-check=%(objectsize:disk)'], cwd=path,
+                         input='\n'.join(objects) + '\n')
+    if output is None:
+        return None
+    return sum([int(line) for line in output.splitlines() if line.isdigit()])
+
+
+#------------------------------------------------------------------------------
+# Mirror
+#------------------------------------------------------------------------------
+
+class Mirror:
+    # Local bare mirrors of the git repositories on a remote
+    def __init__(self, name, remote, root, freshness = MirrorFreshness):
+        self.name = name
+        self.remote = remote
+        self.root = root
+        self.freshness = freshness
+
+    def __repr__(self):
+        repr = "" + self.name
+        repr += "\n" + FormatKeyValue('remote', self.remote.name, Indent)
+        repr += "\n" + FormatKeyValue('root', self.root, Indent)
+        repr += "\n" + FormatKeyValue('freshness', str(self.freshness), Indent)
         return repr
 
+    def path(self, remote_path):
+        path = os.path.join(os.path.expanduser(self.root), remote_path)
+        if not path.endswith('.git'):
+            path += '.git'
+        return path
+
+
+class MirrorUpdater:
+    # Brings mirrors up to date, at most once per run.  Projects which share
+    # a repository may be synchronised concurrently, so each mirror is
+    # updated under a lock of its own, and later projects reuse the result.
+    # The time of the last successful fetch is stored in the mirror.
+    StampFile = 'metasystem-sync-fetched'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = { }
+        self.results = { }
+
+    def reset(self):
+        # Called at the start of each run
+        with self.lock:
+            self.results = { }
+
+    def refresh(self, mirror, url, remote_path, options):
+        # Returns the path of the mirror of the repository at url, or None
+        # if it could not be brought up to date
+        path = mirror.path(remote_path)
+        with self.lock:
+            lock = self.locks.setdefault(path, threading.Lock())
+        with lock:
+            if not path in self.results:
+                self.results[path] = self._refresh(mirror, path, url, options)
+            return self.results[path]
+
+    def _refresh(self, mirror, path, url, options):
+        stamp = os.path.join(path, self.StampFile)
+        execute = not options.dry_run
+        if not os.path.isdir(path):
+            parent = os.path.dirname(path)
+            if execute and not os.path.isdir(parent):
+                os.makedirs(parent)
+            success = Execute('git clone --mirror ' + url + ' ' + path, options, execute)
+        elif os.path.exists(stamp) and time() - os.path.getmtime(stamp) < mirror.freshness:
+            return path
+        else:
+            success = Execute('git fetch --prune origin', options, execute, cwd=path)
+        if not success:
+            PrintWarning("Failed to update mirror '" + path + "'; using remote '" +
+                         mirror.remote.name + "'")
+            return None
+        if execute:
+            open(stamp, 'w').close()
+        return path
+
+
+mirrorUpdater = MirrorUpdater()
+
+
+#------------------------------------------------------------------------------
+# RemoteLease
+#------------------------------------------------------------------------------
+
+# Takes, renews or releases a lease.  Arguments are the operation, the path of
+# the lease directory, the identity of the caller and the lease's lifetime.
+# Prints the identity of the holder and the expiry time, as read back from
+# the lease, and exits with 0 if the caller holds the lease, 1 if another host
+# does, and 2 on error.
+#
+# mkdir is atomic, so only one host can create the lease.  An expired lease
+# is taken over by rewriting its owner file, which requires creating a token
+# directory named after the expired holder and expiry time: only one host can
+# create it, and the owner is read again afterwards, so a host acting on a
+# stale read of the lease backs off.  A holder cannot renew a lease which has
+# expired, since another host may be taking it over; 'expired' is printed
+# instead of the holder.
+LeaseScript = '''
+op=$1 lease=$2 owner=$3 ttl=$4
+now=$(date +%s)
+read holder expiry 2>/dev/null < "$lease/owner"
+report() {
+    read holder expiry 2>/dev/null < "$lease/owner"
+    echo "${holder:-none} ${expiry:-0}"
+    [ "$holder" = "$owner" ] || exit 1
+    exit 0
+}
+case $op in
+acquire)
+    mkdir -p "$(dirname "$lease")" || exit 2
+    if ! mkdir "$lease" 2>/dev/null && [ "$holder" != "$owner" ]; then
+        if [ -n "$holder" ]; then
+            [ "$expiry" -lt "$now" ] || report
+        else
+            # The holder may not yet have recorded itself
+            [ -n "$(find "$lease" -prune -mmin +1)" ] || report
+        fi
+        token="$lease/taken.${holder:-none}.${expiry:-0}"
+        mkdir "$token" 2>/dev/null || report
+        was="$holder $expiry"
+        read holder expiry 2>/dev/null < "$lease/owner"
+        [ "$holder $expiry" = "$was" ] || report
+    fi
+    ;;
+renew)
+    [ "$holder" = "$owner" ] || report
+    [ "$expiry" -ge "$now" ] || { echo "expired $expiry"; exit 1; }
+    ;;
+release)
+    [ "$holder" = "$owner" ] && rm -rf "$lease"
+    exit 0
+    ;;
+esac
+echo "$owner $((now + ttl))" > "$lease/owner.$$" && mv -f "$lease/owner.$$" "$lease/owner" || exit 2
+report
+'''
+
+
+class RemoteLease:
+    # An advisory lease on the remote copy of a project, which is held while
+    # the project is synchronised so that other hosts do not synchronise it
+    # at the same time.  The lease is stored on the remote (see LeaseScript),
+    # and is renewed by a heartbeat thread until it is released.  If a
+    # renewal shows that the lease was lost, lost is set, and the job which
+    # holds the lease fails.
+    Suffix = '.metasystem-sync-lease'
+
+    def __init__(self, project, target, path, ttl):
+        self.project = project
+        self.target = target
+        (parent, base) = os.path.split(os.path.normpath(path))
+        if base in ('', '.', '..'):
+            base = project.name
+        self.path = os.path.join(parent, '.' + base + self.Suffix)
+        self.ttl = ttl
+        self.owner = socket.gethostname() + ':' + str(os.getpid())
+        self.held = False
+        self.lost = False
+        self.renewed = None
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def _run(self, operation):
+        # Returns the (holder, expiry) printed by LeaseScript, or None if it
+        # failed
+        args = [operation, self.path, self.owner, str(self.ttl)]
+        if self.target:
+            command = SshArgs(self.target, ['-o', 'BatchMode=yes'])
+            command.append(' '.join(['sh', '-c', ShellQuote(LeaseScript), 'sh'] +
+                                    [ShellQuote(x) for x in args]))
+        else:
+            command = ['sh', '-c', LeaseScript, 'sh'] + args
+        output = QueryOutput(command, codes=[0, 1])
+        fields = (output or '').split()
+        if len(fields) != 2:
+            return None
+        return (fields[0], fields[1])
+
+    def acquire(self, wait):
+        # Returns True once the lease is held, or False if another host still
+        # holds it after wait seconds.  Raises IOError if the lease cannot be
+        # read or written.
+        deadline = time() + wait
+        while True:
+            result = self._run('acquire')
+            if not result:
+                raise IOError("Failed to take lease '" + self.path + "' for project '" +
+                              self.project.name + "'")
+            if result[0] == self.owner:
+                break
+            remaining = deadline - time()
+            if remaining <= 0:
+                PrintWarning("Project '" + self.project.name + "' is being synchronised by " +
+                             result[0] + "; skipping")
+                return False
+            print("Project '" + self.project.name + "' is being synchronised by " +
+                  result[0] + "; waiting")
+            sleep(min(LeasePollInterval, remaining))
+        self.held = True
+        self.renewed = time()
+        self.timer = RepeatTimer(max(1, self.ttl / 3), self.renew)
+        # Timers started by a daemon thread are also daemons, so a pending
+        # renewal does not delay exit
+        self.timer.daemon = True
+        self.timer.start()
+        return True
+
+    def renew(self):
+        # Called by the heartbeat thread.  A failure to reach the remote is
+        # tolerated until the lease would have expired.
+        with self.lock:
+            if not self.held:
+                return
+            result = self._run('renew')
+            if result and result[0] == self.owner:
+                self.renewed = time()
+                return
+            if result and result[0] == 'expired':
+                reason = 'it expired'
+            elif result:
+                reason = 'it is now held by ' + result[0]
+            elif time() - self.renewed >= self.ttl:
+                reason = 'it could not be renewed'
+            else:
+                return
+            self.held = False
+            self.lost = True
+            PrintError("Lost lease on project '" + self.project.name + "': " + reason)
+
+    def release(self):
+        if self.timer:
+            self.timer.cancel()
+        with self.lock:
+            if self.held:
+                self._run('release')
+                self.held = False
+
+
+#------------------------------------------------------------------------------
+# Metrics
+#------------------------------------------------------------------------------
+
+class Metrics:
+    # Writes timing and throughput records to a file, one JSON object per
+    # line.  Every record carries its type, the time at which it was written
+    # and an identifier for the run, so that records from many runs can be
+    # appended to the same file.
+    def __init__(self):
+        self.file = None
+        self.run = None
+        self.lock = threading.Lock()
+
+    def open(self, filename, action):
+        self.file = open(filename, 'a')
+        self.run = '%s-%d-%d' % (socket.gethostname(), int(time()), os.getpid())
+        self.action = action
+
+    def record(self, type, **fields):
+        if not self.file:
+            return
+        fields['type'] = type
+        fields['run'] = self.run
+        fields['action'] = self.action
+        fields['time'] = round(time(), 3)
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    @contextmanager
+    def phase(self, name, **fields):
+        start = time()
+        try:
+            yield
+        finally:
+            self.record('phase', phase=name, duration=round(time() - start, 3), **fields)
+
+
+metrics = Metrics()
+
+
+#------------------------------------------------------------------------------
+# Report
+#------------------------------------------------------------------------------
+
+class Report:
+    # With --format json, each action writes its result to standard output
+    # as a single JSON document, and all other output goes to standard error
+    # without colour.
+    def __init__(self):
+        self.stream = None
+
+    def open(self, stream):
+        self.stream = stream
+
+    def enabled(self):
+        return self.stream is not None
+
+    def write(self, document):
+        if not self.stream:
+            return
+        self.stream.write(json.dumps(document, sort_keys=True, indent=2) + '\n')
+        self.stream.flush()
+
+
+def ObjectToJson(obj):
+    # Returns the plain attributes of a configuration object.  References to
+    # locals and remotes are replaced by their names.
+    result = { }
+    for key, value in vars(obj).items():
+        if isinstance(value, (Local, Remote)):
+            value = value.name
+        if value is None or isinstance(value, (basestring, int, long, float, bool, list, dict)):
+            result[key] = value
+    return result
+
+
+report = Report()
 
 
 #------------------------------------------------------------------------------
@@ -313,89 +1558,245 @@ class Remote:
 #------------------------------------------------------------------------------
 
 class History:
-    def __init__(self, config):
-        self.lastRun = 0
-        self.lastSuccessfulRun = 0
+    # The history of all runs is stored in an SQLite database.  Every
+    # operation on a project (or on a branch of a git project) is recorded as
+    # a separate row, so concurrent invocations of this script never
+    # overwrite each other's records.
+    #
+    # Records are buffered until write() is called, at which point they are
+    # inserted in a single transaction.  A History which has no database,
+    # such as one used by a worker thread, just collects records, which are
+    # then passed to merge() on the main History.
+    #
+    # A sync run is instead recorded as it progresses: beginRun() inserts the
+    # run, together with the remote and projects selected on the command line
+    # and the process running it, and checkpoint() writes the records of each
+    # job as it completes, together with a checkpoint row naming the job and
+    # its remote.  A run which has no end time, and whose process has exited,
+    # was interrupted; resumableJobs() lists the jobs which it completed.
+    def __init__(self, config, database = None):
         self.config = config
-        self.projects = []
-
-    def setLastRun(self, time, success):
-        self.lastRun = time
-        if success:
-            self.lastSuccessfulRun = time
-
-    def setProjectLastRun(self, projectName, time, success, operation = None):
-        def _doSetProjectLastRun(project, time, success, operation):
-            if 'pull' == operation:
-                project.lastPull = time
-                if success:
-                    project.lastSuccessfulPull = time
-            if 'push' == operation:
-                project.lastPush = time
-                if success:
-                    project.lastSuccessfulPush = time
-        project = self._project(projectName, True)
-        if operation:
-            _doSetProjectLastRun(project, time, success, operation)
-        else:
-            _doSetProjectLastRun(project, time, success, 'pull')
-            _doSetProjectLastRun(project, time, success, 'push')
-
-    def read(self, file):
-        lines = file.readlines()
-        for line in lines:
-            line = line.strip()
-            if len(line) and not line.startswith('#'):
-                tokens = line.split()
-                name = tokens.pop(0)
-                if 'sync' == name:
-                    self.lastRun = int(tokens[0])
-                    self.lastSuccessfulRun = int(tokens[1])
-                else:
-                    self.projects.append(ProjectHistory(name, \
-                                         int(tokens[0]), int(tokens[1]), \
-                                         int(tokens[2]), int(tokens[3]) ) )
-        return
+        self.database = database
+        self.run = None
+        self.runId = None
+        self.records = []
 
-    def write(self, file):
-        file.write('sync ' + str.join(' ', [str(self.lastRun), \
-                                            str(self.lastSuccessfulRun)] ) \
-                   + '\n')
-        for project in self.projects:
-            file.write(str.join(' ', [project.name, \
-                                     str(project.lastPush), \
-                                     str(project.lastSuccessfulPush),
-                                     str(project.lastPull),
-                                     str(project.lastSuccessfulPull)] ) \
-                       + '\n')
-        return
+    def setLastRun(self, start, success):
+        self.run = (start, success)
 
-    def _project(self, name, create = False):
-        result = None
-        for project in self.projects:
-            if name == project.name:
-                result = project
-        if not result and create:
-            result = ProjectHistory(name)
-            self.projects.append(result)
-        return result
+    def beginRun(self, start, remote, selection):
+        if not self.database:
+            return
+        try:
+            with self.database:
+                cursor = self.database.cursor()
+                cursor.execute('INSERT INTO runs (start, remote, selection, host, pid) ' +
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (start, remote, selection, socket.gethostname(), os.getpid()))
+                self.runId = cursor.lastrowid
+        except sqlite3.Error as e:
+            PrintWarning("Failed to record start of run: " + str(e))
+
+    def checkpoint(self, jobName, remoteName, success):
+        # Writes the records collected so far, and notes that the job has
+        # completed
+        if not self.runId:
+            return
+        try:
+            with self.database:
+                cursor = self.database.cursor()
+                self._insertRecords(cursor, self.runId)
+                cursor.execute('INSERT INTO checkpoints (run, job, remote, time, success) ' +
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (self.runId, jobName, remoteName, int(time()), int(success)))
+            self.records = []
+        except sqlite3.Error as e:
+            PrintWarning("Failed to checkpoint project '" + jobName + "': " + str(e))
+
+    def resumableJobs(self, remote, selection):
+        # Returns the (job, remote name) pairs which completed successfully in
+        # the most recent sync run with the same remote and selection of
+        # projects, if that run was interrupted, or else None.  Raises
+        # IOError if that run is still in progress.
+        row = self.database.execute('SELECT id, end, host, pid FROM runs ' +
+                                    'WHERE remote = ? AND selection = ? ' +
+                                    'ORDER BY id DESC LIMIT 1',
+                                    (remote, selection)).fetchone()
+        if not row or row[1] is not None:
+            return None
+        if row[2] == socket.gethostname() and ProcessExists(row[3]):
+            raise IOError("The last sync run is still in progress (process " +
+                          str(row[3]) + ")")
+        rows = self.database.execute('SELECT DISTINCT job, remote FROM checkpoints ' +
+                                     'WHERE run = ? AND success', (row[0],)).fetchall()
+        return set([(row[0], row[1]) for row in rows])
+
+    def setProjectLastRun(self, projectName, start, success, operation = None, branch = None):
+        if branch:
+            projectName += '/' + branch
+        operations = ['pull', 'push']
+        if operation:
+            operations = [operation]
+        duration = max(0, time() - start)
+        exitCode = 0
+        if not success:
+            exitCode = LastExitCode()
+        bytes = TakeUnrecordedBytes()
+        for operation in operations:
+            record = ProjectRun(projectName, operation, start, duration,
+                                exitCode, success)
+            # Data transferred is attributed to a single record, so that it
+            # is not counted twice
+            record.bytes = bytes
+            bytes = None
+            self.records.append(record)
+
+    def merge(self, records):
+        self.records += records
+
+    def write(self):
+        end = int(time())
+        with self.database:
+            cursor = self.database.cursor()
+            run = self.runId
+            if self.run and run:
+                cursor.execute('UPDATE runs SET end = ?, success = ? WHERE id = ?',
+                               (end, int(self.run[1]), run))
+            elif self.run:
+                cursor.execute('INSERT INTO runs (start, end, success) VALUES (?, ?, ?)',
+                               (self.run[0], end, int(self.run[1])))
+                run = cursor.lastrowid
+            self._insertRecords(cursor, run)
+        self.records = []
+
+    def _insertRecords(self, cursor, run):
+        cursor.executemany('INSERT INTO project_runs (run, project, operation, ' +
+                           'time, duration, bytes, exit_code, success) ' +
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(run, record.project, record.operation, record.start,
+                             record.duration, record.bytes, record.exitCode,
+                             int(record.success)) for record in self.records])
+
+    def _lastRuns(self):
+        row = self.database.execute('SELECT MAX(start), ' +
+                                    'MAX(CASE WHEN success THEN start END) ' +
+                                    'FROM runs').fetchone()
+        return (row[0] or 0, row[1] or 0)
+
+    def _project(self, name):
+        row = self.database.execute(
+            'SELECT ' +
+            "MAX(CASE WHEN operation = 'pull' THEN time END), " +
+            "MAX(CASE WHEN operation = 'pull' AND success THEN time END), " +
+            "MAX(CASE WHEN operation = 'push' THEN time END), " +
+            "MAX(CASE WHEN operation = 'push' AND success THEN time END) " +
+            'FROM project_runs WHERE project = ?', (name,)).fetchone()
+        if row[0] is None and row[2] is None:
+            return None
+        return ProjectHistory(name, row[0] or 0, row[1] or 0, row[2] or 0, row[3] or 0)
+
+    def _branches(self, name):
+        # Names of the form '<project>/<branch>' sort between '<project>/'
+        # and '<project>0'
+        rows = self.database.execute('SELECT DISTINCT project FROM project_runs ' +
+                                     'WHERE project > ? AND project < ? ORDER BY project',
+                                     (name + '/', name + '0')).fetchall()
+        return [row[0] for row in rows]
+
+    def _trend(self, name, count):
+        # Returns (runs, successful runs, mean duration) over the most recent
+        # operations on a project.  The mean duration is None if none of them
+        # has a duration.
+        return self.database.execute('SELECT COUNT(*), SUM(success), AVG(duration) FROM ' +
+                                     '(SELECT success, duration FROM project_runs ' +
+                                     'WHERE project = ? ORDER BY time DESC LIMIT ?)',
+                                     (name, count)).fetchone()
+
+    def throughput(self, name):
+        # Returns the mean throughput, in bytes/sec, of recent successful
+        # transfers of a project, or None if too little data was transferred
+        # to tell
+        row = self.database.execute('SELECT SUM(bytes), SUM(duration) FROM ' +
+                                    '(SELECT bytes, duration FROM project_runs ' +
+                                    'WHERE project = ? AND bytes > 0 AND success ' +
+                                    'ORDER BY time DESC LIMIT ?)',
+                                    (name, HistoryTrendLength)).fetchone()
+        if not row[0] or not row[1] or row[0] < CompressionSampleBytes:
+            return None
+        return row[0] / row[1]
+
+    def toJson(self):
+        (lastRun, lastSuccessfulRun) = self._lastRuns()
+        def _history(history):
+            return {
+                'last_pull': history.lastPull or None,
+                'last_successful_pull': history.lastSuccessfulPull or None,
+                'last_push': history.lastPush or None,
+                'last_successful_push': history.lastSuccessfulPush or None
+            }
+        projects = { }
+        for name in self.config['projects'].keys():
+            history = self._project(name)
+            entry = { 'type': self.config['projects'][name].type }
+            if history:
+                entry.update(_history(history))
+                (runs, successes, duration) = self._trend(name, HistoryTrendLength)
+                entry['recent'] = { 'operations': runs, 'successes': successes,
+                                    'mean_duration': duration }
+                entry['throughput'] = self.throughput(name)
+            branches = { }
+            for branch in self._branches(name):
+                branches[branch[len(name) + 1:]] = _history(self._project(branch))
+            if len(branches):
+                entry['branches'] = branches
+            projects[name] = entry
+        return {
+            'last_run': lastRun or None,
+            'last_successful_run': lastSuccessfulRun or None,
+            'projects': projects
+        }
 
     def printToConsole(self):
         now = int(time())
+        (lastRun, lastSuccessfulRun) = self._lastRuns()
         sys.stdout.write('Last run:                 ')
-        PrintDuration(now, self.lastRun)
+        PrintDuration(now, lastRun)
         sys.stdout.write('\n')
         color = Color.WHITE
-        if self.lastSuccessfulRun != self.lastRun:
+        if lastSuccessfulRun != lastRun:
             color = Color.YELLOW
         PrintToConsole('Last successful run:      ', color)
-        PrintDuration(now, self.lastSuccessfulRun)
+        PrintDuration(now, lastSuccessfulRun)
         sys.stdout.write('\n')
         for name in self.config['projects'].keys():
             project = self.config['projects'][name]
             history = self._project(name)
             print()
             project.printHistory(history, now)
+            if history:
+                (runs, successes, duration) = self._trend(name, HistoryTrendLength)
+                line = '    Recent operations:    ' + str(successes) + '/' + str(runs) + ' succeeded'
+                # Operations imported from ~/.sync-history have no duration
+                if duration is not None:
+                    line += ', mean duration ' + FormatDuration(int(duration))
+                print(line)
+            for branch in self._branches(name):
+                project.printBranchHistory(self._project(branch), now)
+
+
+#------------------------------------------------------------------------------
+# ProjectRun
+#------------------------------------------------------------------------------
+
+class ProjectRun:
+    def __init__(self, project, operation, start, duration, exitCode, success):
+        self.project = project
+        self.operation = operation
+        self.start = start
+        self.duration = duration
+        self.bytes = None
+        self.exitCode = exitCode
+        self.success = success
 
 
 #------------------------------------------------------------------------------
@@ -421,19 +1822,127 @@ class ProjectGroup:
     def __init__(self, name):
         self.name = name
         self.projects = []
+        # Map from project name to the names of the projects which it must
+        # follow.  A project which requires another is skipped if that
+        # project fails; a project which is only after another is not.
+        self.after = { }
+        self.requires = { }
 
     def __repr__(self):
         repr = FormatKeyValue('name', self.name)
         repr += "\n" + FormatKeyValue('projects', ' '.join(self.projects))
+        if len(self.after):
+            repr += "\n" + FormatKeyValue('after', FormatDependencies(self.after))
+        if len(self.requires):
+            repr += "\n" + FormatKeyValue('requires', FormatDependencies(self.requires))
         return repr
 
 
+def FormatDependencies(edges):
+    return ' '.join([name + ':' + ','.join(edges[name]) for name in sorted(edges.keys())])
+
+
+#------------------------------------------------------------------------------
+# ProjectStatus
+#------------------------------------------------------------------------------
+
+class ProjectStatus:
+    # Summary of the state of a project, as shown by 'status'.  changes is the
+    # number of local modifications; ahead and behind are the number of
+    # commits (for SCM projects) or files (for rsync / unison projects) which
+    # would be pushed and pulled by a sync.  Values which could not be
+    # determined are None.
+    def __init__(self, project):
+        self.name = project.name
+        self.type = project.type
+        self.branch = None
+        self.changes = None
+        self.ahead = None
+        self.behind = None
+        self.note = None
+        self.error = None
+
+    def clean(self):
+        return not self.error and not self.changes and not self.ahead and not self.behind
+
+
+def ParseItemizedChanges(output):
+    # Counts the entries in the output of 'rsync --itemize-changes' which
+    # would be transferred or deleted.  Entries which start with '.' only
+    # have their attributes updated.
+    count = 0
+    for line in output.splitlines():
+        if line.startswith('*deleting'):
+            count += 1
+        elif re.match(r'[<>ch][fdLDS]\S{9} ', line):
+            count += 1
+    return count
+
+
+class ProjectPlan:
+    # What a sync of a project would transfer, as shown by 'sync -n'.  push
+    # and pull are the number of commits (SCM projects) or files (rsync /
+    # unison projects) which would be transferred in each direction, and
+    # pushBytes and pullBytes estimates of their size.  Values which could
+    # not be determined, or which do not apply, are None.
+    def __init__(self, project):
+        self.name = project.name
+        self.type = project.type
+        self.upToDate = False
+        self.push = None
+        self.pull = None
+        self.pushBytes = None
+        self.pullBytes = None
+        self.note = None
+        self.error = None
+
+    def clean(self):
+        if self.upToDate:
+            return True
+        return not self.error and not self.push and not self.pull and not self.note
+
+
+class ProjectVerification:
+    # Result of comparing the digests of the local and remote copies of a
+    # project's files, as shown by 'verify'.  files is the number of files
+    # compared, and hashed the number which were read, on either side,
+    # because their digests were not cached.
+    def __init__(self, project):
+        self.name = project.name
+        self.type = project.type
+        self.files = 0
+        self.hashed = 0
+        self.differ = []
+        self.localOnly = []
+        self.remoteOnly = []
+        self.note = None
+        self.error = None
+
+    def clean(self):
+        return not self.error and not self.differ and not self.localOnly and not self.remoteOnly
+
+    def compare(self, local, remote):
+        names = sorted(set(local.keys()) | set(remote.keys()))
+        for name in names:
+            if not name in remote:
+                self.localOnly.append(name)
+            elif not name in local:
+                self.remoteOnly.append(name)
+            elif local[name] != remote[name]:
+                self.differ.append(name)
+        self.files = len(names)
+
+
 
 #------------------------------------------------------------------------------
 # Project
 #------------------------------------------------------------------------------
 
 class Project:
+    # True for projects whose transfers can be limited to a share of their
+    # remote's bandwidth
+    bandwidthLimited = False
+
     def __init__(self, name, auto, direction, local, local_path, default_remote, remote_path):
         self.name = name
         self.auto = auto
@@ -488,6 +1997,169 @@ class Project:
     def fullLocalPath(self):
         return os.path.join(self.local.root, self.local_path)
 
+    def sshTarget(self, remote):
+        return SshTarget(remote.root)
+
+    def upToDate(self, options, config):
+        # Returns True if it is known, without transferring any data, that
+        # there is nothing to synchronise
+        return False
+
+    def operations(self, options):
+        # Returns the operations which a sync of the project performs
+        if self.direction:
+            return [self.direction]
+        return ['pull', 'push']
+
+    def setUpToDate(self, history, now, options):
+        for operation in self.operations(options):
+            history.setProjectLastRun(self.name, now, True, operation)
+
+    def _snapshotPath(self, remote):
+        # Snapshots are kept per remote, since the local tree may have been
+        # synchronised with each remote at a different time
+        return os.path.join(os.environ.get('HOME'), '.sync-snapshots',
+                            self.name + '@' + remote.name)
+
+    def _takeSnapshot(self):
+        # The snapshot taken by upToDate is reused by the subsequent sync
+        current = getattr(self, 'localSnapshot', None)
+        self.localSnapshot = None
+        if not current:
+            current = snapshot.scan(self.fullLocalPath())
+        return current
+
+    def _saveSnapshot(self, current, remote):
+        try:
+            snapshot.save(current, self._snapshotPath(remote))
+        except (IOError, OSError) as e:
+            PrintWarning("Failed to save snapshot of project '" + self.name + "': " + str(e))
+
+    def collectStatus(self, options, config):
+        # Returns a ProjectStatus.  This is called concurrently for different
+        # projects, so must not print anything.
+        status = ProjectStatus(self)
+        if not os.path.isdir(self.fullLocalPath()):
+            status.error = 'not initialised'
+        else:
+            self._collectStatus(status, options, config)
+        return status
+
+    def _collectStatus(self, status, options, config):
+        pass
+
+    def _localChanges(self, remote):
+        # Number of paths under the local path which have changed since the
+        # last successful sync with remote, or None if there is no snapshot
+        previous = snapshot.load(self._snapshotPath(remote))
+        if not previous:
+            return None
+        current = snapshot.scan(self.fullLocalPath())
+        return len(current.changed(previous)) + len(current.deleted(previous))
+
+    def _localUpToDate(self, remote):
+        # A push-only project has nothing to transfer if nothing under the
+        # local path has changed since the last successful sync with remote
+        self.localSnapshot = None
+        if self.direction != 'push' or not os.path.isdir(self.fullLocalPath()):
+            return False
+        previous = snapshot.load(self._snapshotPath(remote))
+        if not previous:
+            return False
+        self.localSnapshot = snapshot.scan(self.fullLocalPath())
+        return self.localSnapshot == previous
+
+    def plan(self, options, config, subdir = ''):
+        # Returns a ProjectPlan.  This is called concurrently for different
+        # projects, so must not print anything.
+        plan = ProjectPlan(self)
+        if not os.path.isdir(self.fullLocalPath()):
+            plan.error = 'not initialised'
+        elif not options.force and self.upToDate(options, config):
+            plan.upToDate = True
+            (plan.push, plan.pull, plan.pushBytes, plan.pullBytes) = (0, 0, 0, 0)
+            plan.note = 'up to date'
+        else:
+            direction = self.direction
+            if isinstance(self, ScmProject) and options.direction:
+                direction = options.direction
+            self._plan(plan, self.getRemote(options, config), options, direction, subdir)
+        return plan
+
+    def _plan(self, plan, remote, options, direction, subdir):
+        plan.note = 'not supported'
+
+    def _hashCachePath(self, remote = None):
+        # Digests of the files under the local path or, if remote is given,
+        # under the remote path
+        name = self.name
+        if remote:
+            name += '@' + remote.name
+        return os.path.join(os.environ.get('HOME'), '.sync-hashes', name)
+
+    def _saveHashCache(self, cache, remote = None):
+        # This may be called concurrently for different projects, so
+        # failures are not reported; the digests are recomputed next time
+        try:
+            hashcache.save(cache, self._hashCachePath(remote))
+        except (IOError, OSError):
+            pass
+
+    def _remoteTree(self, remote):
+        # Returns a (target, path) tuple locating the remote copy of the
+        # project's files, where target is None if path is local, or None if
+        # the project cannot be verified
+        return None
+
+    def _verifiedPath(self, path):
+        # Returns True if path, relative to the local path, is synchronised
+        return True
+
+    def lease(self, remote):
+        # Returns a RemoteLease on the remote copy of the project, or None if
+        # the remote does not use leases
+        if not remote.lease_ttl:
+            return None
+        tree = self._remoteTree(remote)
+        if not tree:
+            return None
+        return RemoteLease(self, tree[0], tree[1], remote.lease_ttl)
+
+    def verify(self, options, config):
+        # Returns a ProjectVerification.  This is called concurrently for
+        # different projects, so must not print anything.
+        result = ProjectVerification(self)
+        remote = self.getRemote(options, config)
+        tree = self._remoteTree(remote)
+        if not tree:
+            result.note = 'not supported'
+            return result
+        if not os.path.isdir(self.fullLocalPath()):
+            result.error = 'not initialised'
+            return result
+        (target, path) = tree
+        localCache = hashcache.load(self._hashCachePath())
+        remoteCache = hashcache.load(self._hashCachePath(remote))
+        try:
+            local = localCache.digests(self.fullLocalPath())
+            if target:
+                remoteDigests = RemoteDigests(target, path, remoteCache)
+            elif os.path.isdir(path):
+                remoteDigests = remoteCache.digests(path)
+            else:
+                raise IOError("'" + path + "' not found")
+        except (IOError, OSError) as e:
+            result.error = str(e)
+            return result
+        finally:
+            self._saveHashCache(localCache)
+            self._saveHashCache(remoteCache, remote)
+        def _filter(digests):
+            return dict([(x, digests[x]) for x in digests.keys() if self._verifiedPath(x)])
+        result.compare(_filter(local), _filter(remoteDigests))
+        result.hashed = localCache.hashed + remoteCache.hashed
+        return result
+
     def printHistory(self, history, now):
         print(self.name + ' [' + self.type + ']: ')
         if history:
@@ -495,6 +2167,15 @@ class Project:
         else:
             print('    Never synchronised')
 
+    def printBranchHistory(self, history, now):
+        print('    Branch ' + history.name[len(self.name) + 1:] + ':')
+        sys.stdout.write('        Last successful pull: ')
+        PrintDuration(now, history.lastSuccessfulPull)
+        sys.stdout.write('\n')
+        sys.stdout.write('        Last successful push: ')
+        PrintDuration(now, history.lastSuccessfulPush)
+        sys.stdout.write('\n')
+
     def _printHistory(self, history, now):
         sys.stdout.write('    Last pull:            ')
         PrintDuration(now, history.lastPull)
@@ -538,48 +2219,66 @@ class ScmProject(Project):
             PrintWarning("subdir '" + subdir + "' is ignored for " \
                          + self.type + " project '" + self.name + "'")
 
-        direction = self.direction
-        if options.direction:
-            direction = options.direction
-
-        operations = []
-        if direction:
-            operations.append(direction)
-        else:
-            operations.append('pull')
-            operations.append('push')
-
-        if not options.quiet:
-            print("\nChanging directory to " + self.fullLocalPath() + " ...")
-            os.chdir(self.fullLocalPath())
-
         overallSuccess = True
-        for operation in operations:
+        for operation in self.operations(options):
             now = int(time())
             success = True
             if not self.branches:
                 success = self._sync(operation, '', options)
             else:
                 branchList = self.branches.split()
+                branchSuccess = self._syncBranches(operation, branchList, options)
                 for branch in branchList:
-                    success &= self._sync(operation, ' ' + branch, options)
+                    success &= branchSuccess[branch]
+                    if not options.dry_run:
+                        history.setProjectLastRun(self.name, now, branchSuccess[branch],
+                                                  operation, branch)
             if not options.dry_run:
                 history.setProjectLastRun(self.name, now, success, operation)
             overallSuccess &= success
         return overallSuccess
 
+    def operations(self, options):
+        if options.direction:
+            return [options.direction]
+        return Project.operations(self, options)
+
+    def setUpToDate(self, history, now, options):
+        Project.setUpToDate(self, history, now, options)
+        if self.branches:
+            for branch in self.branches.split():
+                for operation in self.operations(options):
+                    history.setProjectLastRun(self.name, now, True, operation, branch)
+
+    def _syncBranches(self, operation, branches, options):
+        # Returns a dictionary mapping each branch name to a success flag
+        result = { }
+        for branch in branches:
+            result[branch] = self._sync(operation, ' ' + branch, options)
+        return result
+
 
 #------------------------------------------------------------------------------
 # GitProject
 #------------------------------------------------------------------------------
 
 class GitProject(ScmProject):
-    def __init__(self, name, auto, direction, local, local_path, default_remote, remote_path, branches):
+    def __init__(self, name, auto, direction, local, local_path, default_remote, remote_path, branches,
+                 clone_depth = None, clone_filter = None, reference = None):
         ScmProject.__init__(self, name, auto, direction, local, local_path, default_remote, remote_path, branches)
         self.type = 'git'
+        self.clone_depth = clone_depth
+        self.clone_filter = clone_filter
+        self.reference = reference
 
     def getFormat(self, remote=None):
         repr = ScmProject.getFormat(self, remote)
+        if self.clone_depth:
+            repr += "\n" + FormatKeyValue('clone_depth', str(self.clone_depth), Indent)
+        if self.clone_filter:
+            repr += "\n" + FormatKeyValue('clone_filter', self.clone_filter, Indent)
+        if self.reference:
+            repr += "\n" + FormatKeyValue('reference', self.reference, Indent)
         return repr
 
     def _remote_path(self, remote, options):
@@ -588,9 +2287,56 @@ class GitProject(ScmProject):
             remote_path += '.git'
         return remote_path
 
+    def _mirrorPath(self, root):
+        # Returns the path of this project's repository in a local mirror of
+        # the remote, or None if it is not there
+        path = os.path.join(os.path.expanduser(root), self.remote_path)
+        for candidate in (path, path + '.git'):
+            if os.path.isdir(candidate):
+                return candidate
+        return None
+
+    def _cloneOptions(self, options):
+        args = ''
+        if self.clone_depth:
+            args += ' --depth ' + str(self.clone_depth)
+            if self.branches:
+                # Otherwise only the remote's default branch is fetched
+                args += ' --no-single-branch'
+        if self.clone_filter:
+            args += ' --filter=' + ShellQuote(self.clone_filter)
+        if self.reference:
+            reference = os.path.join(self.local.root, os.path.expanduser(self.reference))
+            args += ' --reference-if-able ' + ShellQuote(reference)
+        if options.reference:
+            mirror = self._mirrorPath(options.reference)
+            if mirror:
+                args += ' --reference-if-able ' + ShellQuote(mirror) + ' --dissociate'
+            else:
+                PrintWarning("Project '" + self.name + "' not found under '" + options.reference + "'")
+        return args
+
+    def _mirror(self, remote, options):
+        # Returns the path of an up-to-date local mirror of the remote
+        # repository, or None if there is none
+        mirror = config['mirrors'].get(remote.name)
+        if not mirror:
+            return None
+        return mirrorUpdater.refresh(mirror, self._remote_path(remote, options),
+                                     self.remote_path, options)
+
     def _init(self, remote, options):
         remote_path = self._remote_path(remote, options)
-        command = 'git clone ' + remote_path + ' ' + self.fullLocalPath()
+        if (self.clone_depth or self.clone_filter) and remote_path.startswith('/'):
+            # Git ignores --depth and --filter when cloning from a plain path
+            remote_path = 'file://' + remote_path
+        command = 'git clone' + self._cloneOptions(options)
+        mirror = self._mirror(remote, options)
+        if mirror:
+            # Objects are copied from the mirror, and the clone's origin is
+            # the remote
+            command += ' --reference-if-able ' + ShellQuote(mirror) + ' --dissociate'
+        command += ' ' + remote_path + ' ' + self.fullLocalPath()
         return Execute(command, options, (not options.dry_run))
 
     def _sync(self, operation, branch, options):
@@ -601,13 +2347,209 @@ class GitProject(ScmProject):
         if operation == 'push' and branch != '':
             remote = self.getRemote(options, config)
             remote_path = self._remote_path(remote, options)
+        if operation == 'pull' and branch == '':
+            # The current branch is pulled from the mirror, if there is one
+            mirror = self._mirror(self.getRemote(options, config), options)
+            current = self._branchNames()
+            if mirror and current:
+                (remote_path, branch) = (ShellQuote(mirror), current[0])
         command = 'git ' + operation + ' ' + remote_path + ' ' + branch + verbosity
         execute = True
         if options.dry_run == 1:
             command += ' --dry-run'
         if options.dry_run > 1:
             execute = False
-        return Execute(command, options, execute)
+        return Execute(command, options, execute, cwd=self.fullLocalPath())
+
+    def _branchNames(self):
+        # Returns the branches which are synchronised: those listed in the
+        # project, or else the current branch.  Returns None if there is no
+        # current branch.
+        if self.branches:
+            return self.branches.split()
+        current = QueryOutput(['git', 'symbolic-ref', '-q', '--short', 'HEAD'],
+                              cwd=self.fullLocalPath())
+        if not current:
+            return None
+        return [current.strip()]
+
+    def upToDate(self, options, config):
+        remoteRefs = refCache.get(self._remote_path(self.getRemote(options, config), options))
+        if remoteRefs is None:
+            return False
+        output = QueryOutput(['git', 'show-ref', '--heads'], cwd=self.fullLocalPath())
+        if output is None:
+            return False
+        localRefs = ParseRefs(output)
+        branches = self._branchNames()
+        if not branches:
+            return False
+        for branch in branches:
+            if not branch in localRefs or localRefs[branch] != remoteRefs.get(branch):
+                return False
+        return True
+
+    def _syncBranches(self, operation, branches, options):
+        # All branches are transferred by a single git command, so that only
+        # one connection to the remote is made.  If that command fails for
+        # every branch, for example because one of them does not exist
+        # locally or on the remote, each branch is transferred on its own, so
+        # that the others can still succeed.
+        remote = self.getRemote(options, config)
+        remote_path = self._remote_path(remote, options)
+        def _transfer(branches):
+            if operation == 'push':
+                return self._pushBranches(remote_path, branches, options)
+            return self._pullBranches(remote, remote_path, branches, options)
+        result = _transfer(branches)
+        if len(branches) > 1 and not [x for x in branches if result[x]] \
+           and not circuitBreaker.isOpen(remote):
+            PrintWarning("Failed to " + operation + " branches of project '" + self.name +
+                         "' together; trying each branch separately")
+            for branch in branches:
+                result.update(_transfer([branch]))
+        return result
+
+    def _gitCommand(self, operation, options):
+        command = 'git ' + operation
+        if Verbosity.Loud == options.verbosity:
+            command += ' --verbose'
+        if options.dry_run == 1:
+            command += ' --dry-run'
+        return command
+
+    def _pushBranches(self, remote_path, branches, options):
+        command = self._gitCommand('push', options) + ' --porcelain ' + \
+                  remote_path + ' ' + ' '.join(branches)
+        (success, output) = ExecuteCapture(command, options, options.dry_run < 2,
+                                           cwd=self.fullLocalPath())
+        result = { }
+        for branch in branches:
+            result[branch] = success
+        # Porcelain output contains one line per ref, of the form
+        #   <flag> TAB <from>:<to> TAB <summary>
+        # where a flag of '!' means that the ref was rejected
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if len(fields) >= 2 and ':' in fields[1]:
+                ref = fields[1].split(':')[1]
+                branch = ref.replace('refs/heads/', '', 1)
+                if branch in result:
+                    result[branch] = fields[0].strip() != '!'
+        return result
+
+    def _pullBranches(self, remote, remote_path, branches, options):
+        tracking = 'refs/remotes/' + remote.name + '/'
+        refspecs = ['+refs/heads/' + branch + ':' + tracking + branch for branch in branches]
+        mirror = self._mirror(remote, options)
+        if mirror:
+            remote_path = ShellQuote(mirror)
+        command = self._gitCommand('fetch', options) + ' ' + remote_path + \
+                  ' ' + ' '.join(refspecs)
+        success = Execute(command, options, options.dry_run < 2,
+                          cwd=self.fullLocalPath())
+        result = { }
+        for branch in branches:
+            result[branch] = success
+        if not success or options.dry_run:
+            return result
+
+        # Fast-forward local branches from the fetched refs.  The checked-out
+        # branch is merged; others are updated by a fetch from the local
+        # repository, which refuses non-fast-forward updates.
+        current = QueryOutput(['git', 'symbolic-ref', '-q', '--short', 'HEAD'],
+                              cwd=self.fullLocalPath())
+        if current:
+            current = current.strip()
+        for branch in branches:
+            if branch == current:
+                command = 'git merge --ff-only ' + tracking + branch
+            else:
+                command = 'git fetch . ' + tracking + branch + ':refs/heads/' + branch
+            result[branch] = Execute(command, options, cwd=self.fullLocalPath())
+        return result
+
+    def _plan(self, plan, remote, options, direction, subdir):
+        path = self.fullLocalPath()
+        remoteRefs = refCache.get(self._remote_path(remote, options))
+        if remoteRefs is None:
+            plan.error = 'remote not listed'
+            return
+        branches = self._branchNames()
+        if branches is None:
+            plan.error = 'no current branch'
+            return
+        localRefs = ParseRefs(QueryOutput(['git', 'show-ref', '--heads'], cwd=path) or '')
+        local = [localRefs[x] for x in branches if x in localRefs]
+        # Commits which are reachable from remote heads which are present
+        # locally are already on the remote.  If the heads have moved on
+        # since they were last fetched, the remote-tracking branches are
+        # used instead.
+        missing = GitMissingObjects(path, remoteRefs.values())
+        known = [x for x in set(remoteRefs.values()) if not x in missing]
+        if missing:
+            known.append('--remotes')
+        if direction != 'pull':
+            (plan.push, plan.pushBytes) = (0, 0)
+            if local:
+                count = GitRevList(path, local, known, '--count')
+                if count is None:
+                    plan.error = 'git rev-list failed'
+                    return
+                plan.push = int(count)
+                plan.pushBytes = GitObjectsSize(path, local, known)
+        if direction != 'push':
+            heads = [remoteRefs[x] for x in branches if x in remoteRefs]
+            if [x for x in heads if x in missing]:
+                plan.note = 'remote has unfetched commits'
+            elif heads:
+                count = GitRevList(path, heads, local, '--count')
+                if count is None:
+                    plan.error = 'git rev-list failed'
+                    return
+                # All of the objects are already present locally
+                (plan.pull, plan.pullBytes) = (int(count), 0)
+            else:
+                (plan.pull, plan.pullBytes) = (0, 0)
+
+    def _collectStatus(self, status, options, config):
+        path = self.fullLocalPath()
+        output = QueryOutput(['git', 'status', '--porcelain=v2', '--branch'], cwd=path)
+        if output is None:
+            status.error = 'git status failed'
+            return
+        upstream = None
+        status.changes = 0
+        for line in output.splitlines():
+            if line.startswith('# branch.head '):
+                status.branch = line[14:]
+            elif line.startswith('# branch.ab '):
+                fields = line.split()
+                upstream = (int(fields[2][1:]), int(fields[3][1:]))
+            elif not line.startswith('#'):
+                status.changes += 1
+        # Ahead / behind counts are relative to the branch on the remote, as
+        # listed by 'git ls-remote'.  If the remote could not be listed, the
+        # upstream branch of the local branch is used instead.
+        remoteRefs = refCache.get(self._remote_path(self.getRemote(options, config), options))
+        if remoteRefs is None:
+            if upstream:
+                (status.ahead, status.behind) = upstream
+                status.note = 'remote not listed; relative to upstream'
+            else:
+                status.note = 'remote not listed'
+            return
+        sha = remoteRefs.get(status.branch)
+        if not sha:
+            status.note = 'branch not on remote'
+            return
+        counts = QueryOutput(['git', 'rev-list', '--left-right', '--count',
+                              'HEAD...' + sha], cwd=path)
+        if counts is None:
+            # The remote branch head has not been fetched
+            status.note = 'remote has unfetched commits'
+            return
+        (status.ahead, status.behind) = [int(x) for x in counts.split()]
 
     def status(self, options):
         command = ''
@@ -616,9 +2558,7 @@ class GitProject(ScmProject):
         else:
             command = 'git status'
         if not options.quiet:
-            print("Changing directory to " + self.fullLocalPath() + " ...")
-            os.chdir(self.fullLocalPath())
-            Execute(command, options)
+            Execute(command, options, cwd=self.fullLocalPath())
         # 'git status' returns 1 if there are uncommitted changes
         return True
 
@@ -640,14 +2580,49 @@ class HgProject(ScmProject):
         remote_path = remote.root + '/' + self.remote_path
         if (remote.scm_bare):
             remote_path += '.hg'
-        command = 'hg clone ' + remote_path + ' ' + self.fullLocalPath()
+        command = 'hg clone' + self._sshOption() + ' ' + remote_path + ' ' + self.fullLocalPath()
         return Execute(command, options, (not options.dry_run))
 
+    def _sshOption(self):
+        if sshMux.command():
+            return ' --ssh "' + sshMux.command() + '"'
+        return ''
+
     def _sync(self, operation, branch, options):
-        command = 'hg ' + operation
-        return Execute(command, options, (not options.dry_run))
+        command = 'hg ' + operation + self._sshOption()
+        return Execute(command, options, (not options.dry_run),
+                       cwd=self.fullLocalPath())
         return True
 
+    def _plan(self, plan, remote, options, direction, subdir):
+        # 'hg outgoing' and 'hg incoming' exit with 1 if there are no
+        # changesets to transfer
+        for (operation, skip) in (('outgoing', 'pull'), ('incoming', 'push')):
+            if direction == skip:
+                continue
+            args = ['hg', operation, '--quiet', '--template', '{node}\\n']
+            if sshMux.command():
+                args += ['--ssh', sshMux.command()]
+            output = QueryOutput(args, cwd=self.fullLocalPath(), codes=[0, 1])
+            if output is None:
+                plan.error = 'hg ' + operation + ' failed'
+                return
+            if operation == 'outgoing':
+                plan.push = len(output.splitlines())
+            else:
+                plan.pull = len(output.splitlines())
+
+    def _collectStatus(self, status, options, config):
+        path = self.fullLocalPath()
+        output = QueryOutput(['hg', 'status'], cwd=path)
+        if output is None:
+            status.error = 'hg status failed'
+            return
+        status.changes = len(output.splitlines())
+        branch = QueryOutput(['hg', 'branch'], cwd=path)
+        if branch:
+            status.branch = branch.strip()
+
     def status(self, options):
         return True
 
@@ -669,6 +2644,9 @@ class UnisonProject(Project):
         Verbosity.Loud   : ''
     }
 
+    # Names which unison does not synchronise
+    Ignore = ['*~', '.*.swp']
+
     def getFormat(self, remote=None):
         repr = Project.getFormat(self, remote)
         subdirs = '*'
@@ -680,27 +2658,35 @@ class UnisonProject(Project):
     def _generateProfile(self, remote):
         unisonProfilePath = os.path.join(os.environ.get('HOME'), '.unison')
         if not os.path.exists(unisonProfilePath):
-            os.makedirs(unisonProfilePath)
-        commonProfilePath = os.path.join(unisonProfilePath, 'common.prf')
-        profileName = '_sync_' + self.name + '.prf'
-        profilePath = os.path.join(unisonProfilePath, profileName)
-        commonProfile = open(commonProfilePath, 'w')
-        commonProfile.write('ignore = Name *~\n')
-        commonProfile.write('ignore = Name .*.swp\n')
-        commonProfile.write('fastcheck = true\n')
-        commonProfile.write('perms = 0\n')
+            try:
+                os.makedirs(unisonProfilePath)
+            except OSError:
+                # It may have been created by a concurrent job
+                if not os.path.isdir(unisonProfilePath):
+                    raise
+        # common.prf is shared by all unison jobs, which may be running
+        # concurrently, so it is replaced rather than rewritten
+        common = ''
+        for pattern in self.Ignore:
+            common += 'ignore = Name ' + pattern + '\n'
+        common += 'fastcheck = true\n'
+        common += 'perms = 0\n'
         maxthreads = NumberOfCores() / 2
         if maxthreads < 1:
             maxthreads = 1
-        commonProfile.write('maxthreads = ' + str(maxthreads) + '\n')
-        profile = open(profilePath, 'w')
-        profile.write('include common.prf\n')
-        profile.write('root = ' + self.fullLocalPath() + '\n')
-        profile.write('root = ' + remote.root + '/' + self.remote_path + '\n')
+        common += 'maxthreads = ' + str(maxthreads) + '\n'
+        ReplaceFile(os.path.join(unisonProfilePath, 'common.prf'), common)
+        profileName = '_sync_' + self.name + '.prf'
+        profile = 'include common.prf\n'
+        profile += 'root = ' + self.fullLocalPath() + '\n'
+        profile += 'root = ' + remote.root + '/' + self.remote_path + '\n'
         if self.prefer == 'local':
-            profile.write('prefer = ' + self.fullLocalPath() + '\n')
+            profile += 'prefer = ' + self.fullLocalPath() + '\n'
         if self.prefer == 'remote':
-            profile.write('prefer = ' + os.path.join(remote.root, self.remote_path) + '\n')
+            profile += 'prefer = ' + os.path.join(remote.root, self.remote_path) + '\n'
+        if sshMux.command():
+            profile += 'sshargs = -o ControlPath=' + sshMux.controlPath() + '\n'
+        ReplaceFile(os.path.join(unisonProfilePath, profileName), profile)
         return profileName
 
     def _init(self, remote, options):
@@ -709,21 +2695,19 @@ class UnisonProject(Project):
     def sync(self, history, options, subdir):
         now = int(time())
         remote = self.getRemote(options, config)
+        # Unison synchronises in both directions, so the whole tree is
+        # always passed to it.  The snapshot is only used by 'status'.
         success = self._sync(remote, options, subdir)
+        if success and not options.dry_run and '' == subdir:
+            self._saveSnapshot(snapshot.scan(self.fullLocalPath()), remote)
         if not options.dry_run:
             history.setProjectLastRun(self.name, now, success)
         return success
 
-    def _sync(self, remote, options, subdir = ''):
-        try:
-            profile = self._generateProfile(remote)
-        except Exception as e:
-            print(e)
-            return False
-
-        success = True
+    def _command(self, verbosity, subdir):
+        # Returns the unison command line, without the profile name
         command = 'unison -auto -ui text '
-        command += self.VerbosityMap[options.verbosity]
+        command += self.VerbosityMap[verbosity]
         if '' != subdir:
             command += '-path ' + subdir + ' '
         else:
@@ -731,33 +2715,76 @@ class UnisonProject(Project):
                 subdirList = self.subdirs.split()
                 for subdir in subdirList:
                     command += '-path ' + subdir + ' '
-        command += profile
+        return command
+
+    def _sync(self, remote, options, subdir = ''):
+        try:
+            profile = self._generateProfile(remote)
+        except Exception as e:
+            print(e)
+            return False
+
+        success = True
+        command = self._command(options.verbosity, subdir) + profile
         if options.dry_run == 1:
-            # Unison has no -dry-run option, so we resort to nastiness...
-            # Run without -batch, and send 'q' when asked whether to
-            # proceed
             print('\n' + command)
-            process = subprocess.Popen(command.split(),
-                                       shell=True,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT,
-                                       stdin=subprocess.PIPE)
-            output = ''
-            while (True):
-                buf = process.stdout.read(1)
-                if len(buf) == 0:
-                    break
-                output += buf
-                sys.stdout.write(buf)
-                if 'Proceed with propagating updates? [] ' in output:
-                    process.stdin.write('q\n')
-                    break
+            output = UnisonPreview(shlex.split(command))
+            if output is None:
+                return False
+            sys.stdout.write(output)
         else:
             if options.dry_run == 0:
                 command += " -batch"
-            success = Execute(command, options)
+            (success, output) = ExecuteCapture(command, options, mergeStderr=True)
+            (bytes, files) = ParseUnisonStats(output)
+            AddTransferStats(bytes, files)
         return success
 
+    def _plan(self, plan, remote, options, direction, subdir):
+        try:
+            profile = self._generateProfile(remote)
+        except Exception as e:
+            plan.error = str(e)
+            return
+        output = UnisonPreview(shlex.split(self._command(Verbosity.Normal, subdir) + profile))
+        if output is None:
+            plan.error = 'unison failed'
+            return
+        (push, pull, conflicts) = ParseUnisonPlan(output)
+        (plan.push, plan.pull) = (len(push), len(pull))
+        plan.pushBytes = sum([TreeSize(os.path.join(self.fullLocalPath(), x)) for x in push])
+        (target, path) = self._remoteTree(remote)
+        if not target:
+            plan.pullBytes = sum([TreeSize(os.path.join(path, x)) for x in pull])
+        if conflicts:
+            plan.note = str(len(conflicts)) + ' conflicts'
+
+    def _remoteTree(self, remote):
+        root = remote.root + '/' + self.remote_path
+        target = SshTarget(remote.root)
+        if not target:
+            return (None, root)
+        # ssh://host/path is relative to the remote home directory, and
+        # ssh://host//path is absolute
+        path = root[6:].split('/', 1)
+        if len(path) < 2 or not path[1]:
+            return (target, '.')
+        return (target, path[1])
+
+    def _verifiedPath(self, path):
+        if [x for x in self.Ignore if fnmatch.fnmatch(os.path.basename(path), x)]:
+            return False
+        if self.subdirs:
+            return bool([x for x in self.subdirs.split() if path == x or path.startswith(x + '/')])
+        return True
+
+    def _collectStatus(self, status, options, config):
+        # Unison has no dry-run mode which can be run unattended, so only
+        # local changes since the last sync are reported
+        status.changes = self._localChanges(self.getRemote(options, config))
+        if status.changes is None:
+            status.note = 'no snapshot'
+
     def status(self, options):
         return True
 
@@ -778,36 +2805,167 @@ class UnisonProject(Project):
 #------------------------------------------------------------------------------
 
 class RsyncProject(Project):
+    bandwidthLimited = True
+
     def __init__(self, name, auto, direction, local, local_path, default_remote,
-                 remote_path, rsync_options):
+                 remote_path, rsync_options, compress = None, engine = None):
         Project.__init__(self, name, auto, direction, local, local_path, default_remote, remote_path)
         self.type = 'rsync'
         self.rsync_options = rsync_options
+        # If not set, the remote's settings are used
+        self.compress = compress
+        self.engine = engine
+        # Throughput of recent transfers, in bytes/sec, as recorded in the
+        # history database
+        self.throughput = None
+
+    VerbosityMap = {
+        Verbosity.Silent : '',
+        Verbosity.Normal : 'v',
+        Verbosity.Loud   : 'vv'
+    }
+
+    def _compress(self, remote):
+        compress = self.compress or remote.compress
+        if compress == 'auto':
+            # Compression only costs CPU time for local copies, and on links
+            # which have proved to be fast
+            if not self.sshTarget(remote):
+                return False
+            return not (self.throughput and self.throughput >= LanThroughput)
+        return compress == 'true'
+
+    def _command(self, remote, options):
+        command = 'rsync -a'
+        if self._compress(remote):
+            command += 'z'
+        command += self.VerbosityMap[options.verbosity] + ' --stats '
+        bwlimit = getattr(jobState, 'bwlimit', None)
+        if bwlimit:
+            command += '--bwlimit=' + str(bwlimit) + ' '
+        if self.rsync_options:
+            command = command + self.rsync_options
+        return command
 
     def _init(self, remote, options):
         return self._sync(remote, options)
 
+    def sshTarget(self, remote):
+        # The root of an rsync remote is a host name
+        if remote.root.startswith('/'):
+            return None
+        return (remote.root, None)
+
+    def _rsh(self):
+        if sshMux.command():
+            return ' -e "' + sshMux.command() + '" '
+        return ' -e ssh '
+
     def getFormat(self, remote=None):
         repr = Project.getFormat(self, remote)
         rsync_options = ''
         if self.rsync_options:
             rsync_options = self.rsync_options
         repr += "\n" + FormatKeyValue('rsync_options', rsync_options, Indent)
+        repr += "\n" + FormatKeyValue('compress', self.compress or 'remote default', Indent)
+        repr += "\n" + FormatKeyValue('engine', self.engine or 'remote default', Indent)
         return repr
 
+    def upToDate(self, options, config):
+        return self._localUpToDate(self.getRemote(options, config))
+
     def sync(self, history, options, subdir):
         now = int(time())
         remote = self.getRemote(options, config)
-        success = self._sync(remote, options, subdir)
+        # Only the files which have changed locally are pushed.  Deletions
+        # can only be propagated by a full transfer.
+        current = None
+        paths = None
+        if self.direction != 'pull':
+            current = self._takeSnapshot()
+            previous = snapshot.load(self._snapshotPath(remote))
+            if previous and not options.force:
+                paths = current.changed(previous)
+                if len(current.deleted(previous)) and self.rsync_options \
+                   and '--delete' in self.rsync_options:
+                    paths = None
+        success = self._sync(remote, options, subdir, paths)
+        # The snapshot taken before the push is saved, even if files were
+        # then pulled, since a later scan would also record local changes
+        # made during the sync which were never pushed.  Pulled files are
+        # therefore pushed again by the next sync.
+        if success and not options.dry_run and current:
+            self._saveSnapshot(current, remote)
         if not options.dry_run:
-            history.setProjectLastRun(self.name, now, success)
+            for operation in self.operations(options):
+                history.setProjectLastRun(self.name, now, success, operation)
+        return success
+
+    def _rsync(self, command, options, execute, cwd):
+        (success, output) = ExecuteCapture(command, options, execute, cwd=cwd)
+        (bytes, files) = ParseRsyncStats(output)
+        AddTransferStats(bytes, files)
         return success
 
+    def _native(self, remote):
+        # Returns True if files are to be transferred in-process
+        if (self.engine or remote.engine) != 'native':
+            return False
+        if self.sshTarget(remote):
+            PrintWarning("engine = native requires a remote whose root is a local path; " +
+                         "using rsync for project '" + self.name + "'")
+            return False
+        return True
+
+    def _nativeTransfer(self, remote, options, push, paths = None):
+        local = self.fullLocalPath()
+        remotePath = os.path.join(remote.root, self.remote_path)
+        (src, dst) = (local, remotePath)
+        if not push:
+            (src, dst) = (remotePath, local)
+        description = 'native transfer ' + src + ' -> ' + dst
+        if Verbosity.Silent != options.verbosity:
+            print('\n' + description)
+        if options.dry_run > 1:
+            return True
+        rsync_options = (self.rsync_options or '').split()
+        checksum = '--checksum' in rsync_options or '-c' in rsync_options
+        # Files are compared via the digests cached by 'verify'
+        hashes = None
+        if checksum:
+            hashes = (hashcache.load(self._hashCachePath()),
+                      hashcache.load(self._hashCachePath(remote)))
+            if not push:
+                hashes = (hashes[1], hashes[0])
+        try:
+            stats = delta.sync_tree(src, dst, paths,
+                                    delete = '--delete' in rsync_options,
+                                    checksum = checksum,
+                                    dry_run = options.dry_run == 1,
+                                    hashes = hashes,
+                                    inplace = '--inplace' in rsync_options)
+        except (IOError, OSError) as e:
+            PrintError(description + ' failed: ' + str(e))
+            return False
+        finally:
+            if hashes:
+                self._saveHashCache(hashes[0], None if push else remote)
+                self._saveHashCache(hashes[1], remote if push else None)
+        for path in stats.skipped:
+            PrintWarning("Skipping special file '" + path + "'")
+        if Verbosity.Silent != options.verbosity:
+            if options.dry_run or Verbosity.Loud == options.verbosity:
+                for path in stats.paths:
+                    print(path)
+            print(str(stats.files) + ' files, ' + str(stats.bytes) + ' bytes transferred')
+        if not options.dry_run:
+            AddTransferStats(stats.bytes, stats.files)
+        return True
+
     def _pull(self, remote, options, subdir):
-        command = 'rsync -azvvrl '
-        if self.rsync_options:
-            command = command + self.rsync_options
-        command = command + ' -e ssh ' +\
+        if self._native(remote):
+            return self._nativeTransfer(remote, options, False)
+        command = self._command(remote, options) + self._rsh() +\
                   remote.root + ':' + self.remote_path +\
                   " " + self.local_path
         execute = True
@@ -815,34 +2973,569 @@ class RsyncProject(Project):
             command += " --dry-run"
         if options.dry_run > 1:
             execute = False
-        return Execute(command, options, execute)
-
-    def _push(self, remote, options, subdir):
-        print("\nChanging directory to " + self.fullLocalPath() + " ...")
-        os.chdir(self.fullLocalPath())
-        command = 'rsync -azvvrl '
-        if self.rsync_options:
-            command = command + self.rsync_options
-        command = command + ' -e ssh . ' + remote.root + ':' + self.remote_path
+        # local_path is relative to the local root
+        return self._rsync(command, options, execute, cwd=self.local.root)
+
+    def _push(self, remote, options, subdir, paths = None):
+        if paths == []:
+            print("\nNo local changes to push")
+            return True
+        if self._native(remote):
+            return self._nativeTransfer(remote, options, True, paths)
+        command = self._command(remote, options)
+        filesFrom = None
+        if paths:
+            filesFrom = tempfile.NamedTemporaryFile(prefix='metasystem-sync-', delete=False)
+            filesFrom.write('\n'.join(paths) + '\n')
+            filesFrom.close()
+            command = command + ' --files-from=' + filesFrom.name
+        command = command + self._rsh() + '. ' + remote.root + ':' + self.remote_path
         execute = True
         if options.dry_run == 1:
             command += " --dry-run"
         if options.dry_run > 1:
             execute = False
-        return Execute(command, options, execute)
+        try:
+            return self._rsync(command, options, execute, cwd=self.fullLocalPath())
+        finally:
+            if filesFrom:
+                os.remove(filesFrom.name)
 
-    def _sync(self, remote, options, subdir = ''):
+    def _sync(self, remote, options, subdir = '', paths = None):
         result = True
         if self.direction != 'pull':
-            result = self._push(remote, options, subdir)
+            result = self._push(remote, options, subdir, paths)
         if result and self.direction != 'push':
             result = self._pull(remote, options, subdir)
         return result
 
+    def _remoteTree(self, remote):
+        target = self.sshTarget(remote)
+        if target:
+            return (target, self.remote_path)
+        return (None, os.path.join(remote.root, self.remote_path))
+
+    def _nativeDryRun(self, remote, push):
+        # Returns the delta.Stats of a dry run in one direction, if files are
+        # transferred in-process, or else None
+        if (self.engine or remote.engine) != 'native' or self.sshTarget(remote):
+            return None
+        (src, dst) = (self.fullLocalPath(), os.path.join(remote.root, self.remote_path))
+        if not push:
+            (src, dst) = (dst, src)
+        rsync_options = (self.rsync_options or '').split()
+        return delta.sync_tree(src, dst, delete = '--delete' in rsync_options,
+                               checksum = '--checksum' in rsync_options or '-c' in rsync_options,
+                               dry_run = True)
+
+    def _dryRun(self, remote, push):
+        # Returns the output of 'rsync --dry-run --itemize-changes --stats' in
+        # one direction, or None if it failed
+        command = 'rsync -azni --stats '
+        if self.rsync_options:
+            command = command + self.rsync_options
+        command = command + self._rsh()
+        if push:
+            return QueryOutput(shlex.split(command + '. ' + remote.root + ':' + self.remote_path),
+                               cwd=self.fullLocalPath())
+        return QueryOutput(shlex.split(command + remote.root + ':' + self.remote_path +
+                                       ' ' + self.local_path),
+                           cwd=self.local.root)
+
+    def _plan(self, plan, remote, options, direction, subdir):
+        for push in (True, False):
+            if direction == ('pull' if push else 'push'):
+                continue
+            stats = self._nativeDryRun(remote, push)
+            if stats:
+                (count, bytes) = (stats.files + stats.deleted, stats.bytes)
+            else:
+                output = self._dryRun(remote, push)
+                if output is None:
+                    plan.error = 'rsync failed'
+                    return
+                count = ParseItemizedChanges(output)
+                bytes = RsyncStatsValues(output).get('Total transferred file size')
+            if push:
+                (plan.push, plan.pushBytes) = (count, bytes)
+            else:
+                (plan.pull, plan.pullBytes) = (count, bytes)
+
+    def _collectStatus(self, status, options, config):
+        # The number of files to be transferred in each direction is found by
+        # a dry run of rsync
+        remote = self.getRemote(options, config)
+        status.changes = self._localChanges(self.getRemote(options, config))
+        for push in (True, False):
+            if self.direction == ('pull' if push else 'push'):
+                continue
+            stats = self._nativeDryRun(remote, push)
+            if stats:
+                count = stats.files + stats.deleted
+            else:
+                output = self._dryRun(remote, push)
+                if output is None:
+                    status.error = 'rsync failed'
+                    return
+                count = ParseItemizedChanges(output)
+            if push:
+                status.ahead = count
+            else:
+                status.behind = count
+
     def status(self, options):
         return True
 
 
+#------------------------------------------------------------------------------
+# Job
+#------------------------------------------------------------------------------
+
+class Job:
+    def __init__(self, name, project, subdir, remote):
+        self.name = name
+        self.project = project
+        self.subdir = subdir
+        self.remote = remote
+        self.success = False
+        self.upToDate = False
+        self.skipped = False
+        # Bandwidth limit in KiB/s, or None
+        self.bwlimit = None
+        # Jobs which must finish before this one starts.  If any job in
+        # requires does not succeed, this one is skipped.
+        self.after = []
+        self.requires = []
+        self.bytes = None
+        self.files = None
+        self.start = None
+        self.end = None
+        self.logPath = None
+
+    def duration(self):
+        return FormatDuration(int(self.end - self.start))
+
+    def predecessors(self):
+        # Returns the jobs which must finish before this one, directly or
+        # indirectly
+        result = set()
+        pending = self.after + self.requires
+        while len(pending):
+            job = pending.pop()
+            if not job in result:
+                result.add(job)
+                pending += job.after + job.requires
+        return result
+
+
+#------------------------------------------------------------------------------
+# ProgressDisplay
+#------------------------------------------------------------------------------
+
+class ProgressDisplay:
+    # Shows one line per finished job, plus a transient status line listing
+    # the jobs which are still running.  Full logs are shown only for jobs
+    # which failed.
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.running = []
+        self.completed = 0
+        self.statusLength = 0
+        self.live = sys.stdout.isatty()
+
+    def started(self, job):
+        self.running.append(job)
+        self._drawStatus()
+
+    def finished(self, job):
+        if job in self.running:
+            self.running.remove(job)
+        self.completed += 1
+        self._clearStatus()
+        if job.success:
+            PrintToConsole('  OK      ', Color.GREEN)
+        elif job.skipped:
+            PrintToConsole('  SKIPPED ', Color.YELLOW)
+        else:
+            PrintToConsole('  FAILED  ', Color.RED)
+        duration = job.duration()
+        if job.upToDate:
+            duration += ' (up to date)'
+        sys.stdout.write(FormatKeyValue(job.name, duration) + '\n')
+        self._drawStatus()
+
+    def close(self):
+        self._clearStatus()
+        for job in self.jobs:
+            if not job.success and job.logPath:
+                PrintToConsole("\nOutput of project '" + job.name + "':\n", Color.RED)
+                try:
+                    with open(job.logPath, 'r') as log:
+                        shutil.copyfileobj(log, sys.stdout)
+                except IOError as e:
+                    PrintError(str(e))
+
+    def _drawStatus(self):
+        self._clearStatus()
+        if not self.live or not len(self.running):
+            return
+        status = '[' + str(self.completed) + '/' + str(len(self.jobs)) + '] ' + \
+                 ' '.join([job.name for job in self.running])
+        if len(status) > 79:
+            status = status[:76] + '...'
+        PrintToConsole(status, Color.YELLOW)
+        sys.stdout.flush()
+        self.statusLength = len(status)
+
+    def _clearStatus(self):
+        if self.statusLength:
+            sys.stdout.write('\r' + ' ' * self.statusLength + '\r')
+            self.statusLength = 0
+
+
+#------------------------------------------------------------------------------
+# Scheduler
+#------------------------------------------------------------------------------
+
+def _RunJob(func, job, history):
+    ResetJobState(job.remote, job.project.sshTarget(job.remote))
+    jobState.bwlimit = job.bwlimit
+    try:
+        success = func(job, history)
+        if success:
+            circuitBreaker.success(job.remote)
+        return success
+    except Exception as e:
+        print(e)
+        return False
+    finally:
+        job.bytes = jobState.bytes
+        job.files = jobState.files
+
+
+def _RunJobThread(func, index, job, config, results):
+    history = History(config)
+    success = False
+    try:
+        with open(job.logPath, 'w', 0) as log:
+            SetJobOutput(log)
+            try:
+                success = _RunJob(func, job, history)
+            finally:
+                SetJobOutput(None)
+    except IOError as e:
+        PrintError(str(e))
+    results.put((index, success, history.records))
+
+
+def RunConcurrently(func, items, maxThreads):
+    # Calls func on each item, in up to maxThreads threads, and returns the
+    # results in the same order as the items
+    results = [None] * len(items)
+    pending = queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                (index, item) = pending.get(False)
+            except queue.Empty:
+                return
+            results[index] = func(item)
+
+    threads = []
+    for i in range(min(maxThreads, len(items))):
+        thread = threading.Thread(target = worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Scheduler:
+    # Runs a list of jobs, at most maxJobs at a time.  Jobs which share a
+    # remote host are further limited by that remote's max_jobs setting.
+    #
+    # Jobs may depend on other jobs (see addDependencies), in which case they
+    # are started as soon as the jobs which they depend on have finished.  If
+    # a required job fails, the jobs which depend on it, directly or
+    # indirectly, are skipped; unrelated jobs continue to run.
+    #
+    # Each concurrent job runs in a worker thread, and records its history in
+    # a History object of its own, which is merged into the main one when the
+    # job completes.  Output of concurrent jobs is captured in per-job log
+    # files, and progress is summarised by a ProgressDisplay.
+    def __init__(self, maxJobs):
+        self.maxJobs = max(1, maxJobs)
+        self.jobs = []
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def addDependencies(self, groups):
+        # Adds the after / requires edges of each project group between the
+        # jobs of the projects concerned.  Edges to projects which are not
+        # being synchronised are ignored.
+        jobsByProject = { }
+        for job in self.jobs:
+            jobsByProject.setdefault(job.project.name, []).append(job)
+        for group in groups:
+            for (edges, required) in ((group.after, False), (group.requires, True)):
+                for name in edges.keys():
+                    for job in jobsByProject.get(name, []):
+                        for predecessor in edges[name]:
+                            for other in jobsByProject.get(predecessor, []):
+                                if required:
+                                    job.requires.append(other)
+                                else:
+                                    job.after.append(other)
+        self._sort()
+
+    def _sort(self):
+        # Orders the jobs so that each follows those which it depends on.
+        # Among the jobs which are ready to run, those with the longest chain
+        # of dependent jobs come first, so that chains are started as early
+        # as possible.
+        dependents = dict([(job, []) for job in self.jobs])
+        for job in self.jobs:
+            for other in job.after + job.requires:
+                dependents[other].append(job)
+        depth = { }
+        def _depth(job):
+            if not job in depth:
+                depth[job] = 1 + max([0] + [_depth(x) for x in dependents[job]])
+            return depth[job]
+        ordered = []
+        remaining = list(self.jobs)
+        while len(remaining):
+            ready = [job for job in remaining
+                     if not [x for x in job.after + job.requires if not x in ordered]]
+            if not len(ready):
+                raise IOError("Cyclic dependency between projects " +
+                              ' '.join([job.name for job in remaining]))
+            ready.sort(key = _depth, reverse = True)
+            ordered += ready
+            remaining = [job for job in remaining if not job in ready]
+        self.jobs = ordered
+
+    def _ready(self, job):
+        for other in job.after + job.requires:
+            if other.end is None:
+                return False
+        return True
+
+    def _skipReason(self, job):
+        # Returns the reason why a job which is ready to run must be skipped,
+        # or None
+        for other in job.requires:
+            if other.end is not None and not other.success:
+                return "required project '" + other.name + "' did not succeed"
+        if circuitBreaker.isOpen(job.remote):
+            return "remote '" + job.remote.name + "' is unreachable"
+        return None
+
+    def _skip(self, job, reason, display, doneFunc):
+        job.skipped = True
+        job.success = False
+        job.start = job.end = time()
+        if display:
+            display.finished(job)
+        else:
+            PrintToConsole("\nSkipping project '" + job.name + "' - " + reason + "\n", Color.YELLOW)
+        if doneFunc:
+            doneFunc(job)
+
+    def _setBandwidth(self, job, running):
+        # A job which is starting is given an equal share of its remote's
+        # bandwidth with the other bandwidth-limited jobs running on that
+        # remote.  A transfer's limit cannot be changed once it has started,
+        # so the shares of running jobs are not adjusted.
+        if not job.project.bandwidthLimited or not job.remote.bandwidth:
+            return
+        shares = 1 + len([other for other in running if other.project.bandwidthLimited
+                          and other.remote.root == job.remote.root])
+        job.bwlimit = max(1, job.remote.bandwidth / shares)
+
+    def run(self, history, func, doneFunc = None):
+        if self.maxJobs == 1:
+            self._runSerial(history, func, doneFunc)
+        else:
+            logDir = tempfile.mkdtemp(prefix='metasystem-sync-')
+            try:
+                self._runParallel(history, func, doneFunc, logDir)
+            finally:
+                shutil.rmtree(logDir, ignore_errors=True)
+        success = True
+        for job in self.jobs:
+            success &= job.success
+        return success
+
+    def _runSerial(self, history, func, doneFunc):
+        for job in self.jobs:
+            reason = self._skipReason(job)
+            if reason:
+                self._skip(job, reason, None, doneFunc)
+                continue
+            job.start = time()
+            self._setBandwidth(job, [])
+            job.success = _RunJob(func, job, history)
+            job.end = time()
+            if doneFunc:
+                doneFunc(job)
+
+    def _runParallel(self, history, func, doneFunc, logDir):
+        display = ProgressDisplay(self.jobs)
+        results = queue.Queue()
+        pending = range(len(self.jobs))
+        running = { }
+        remoteJobs = { }
+        while len(pending) or len(running):
+            # Skipping a job may cause jobs which depend on it to be skipped
+            skipped = True
+            while skipped:
+                skipped = False
+                for index in list(pending):
+                    job = self.jobs[index]
+                    reason = self._ready(job) and self._skipReason(job)
+                    if reason:
+                        pending.remove(index)
+                        self._skip(job, reason, display, doneFunc)
+                        skipped = True
+            starting = []
+            for index in list(pending):
+                if len(running) + len(starting) >= self.maxJobs:
+                    break
+                job = self.jobs[index]
+                if not self._ready(job):
+                    continue
+                host = job.remote.root
+                if remoteJobs.get(host, 0) >= job.remote.max_jobs:
+                    continue
+                pending.remove(index)
+                starting.append(index)
+                remoteJobs[host] = remoteJobs.get(host, 0) + 1
+            # Bandwidth is shared equally by the jobs which start together
+            active = [self.jobs[x] for x in running.keys() + starting]
+            for index in starting:
+                job = self.jobs[index]
+                job.logPath = os.path.join(logDir, '%03d-%s.log' % \
+                                           (index, job.name.replace('/', '_')))
+                job.start = time()
+                self._setBandwidth(job, [x for x in active if x is not job])
+                display.started(job)
+                thread = threading.Thread(target = _RunJobThread,
+                             args = (func, index, job, history.config, results))
+                thread.daemon = True
+                thread.start()
+                running[index] = thread
+            if not len(running):
+                continue
+            (index, success, records) = self._wait(results)
+            running.pop(index).join()
+            job = self.jobs[index]
+            job.end = time()
+            remoteJobs[job.remote.root] -= 1
+            job.success = success
+            history.merge(records)
+            display.finished(job)
+            if doneFunc:
+                doneFunc(job)
+        display.close()
+
+    def _wait(self, results):
+        # A blocking get() without a timeout cannot be interrupted by Ctrl-C
+        while True:
+            try:
+                return results.get(True, 1)
+            except queue.Empty:
+                pass
+
+
+#------------------------------------------------------------------------------
+# TreeWatcher
+#------------------------------------------------------------------------------
+
+class TreeWatcher:
+    # Records which projects have changed locally.  The local trees are
+    # watched via inotify if pyinotify is installed; otherwise, they are
+    # polled by comparing snapshots.
+    def __init__(self, projects):
+        self.projects = projects
+        self.changed = { }
+        self.lock = threading.Lock()
+        self.notifier = None
+
+    def start(self):
+        if pyinotify:
+            self._startNotifier()
+        else:
+            thread = threading.Thread(target = self._poll)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        if self.notifier:
+            self.notifier.stop()
+
+    def changes(self, debounce):
+        # Returns the names of the projects which have changed, but not
+        # within the last debounce seconds
+        now = time()
+        with self.lock:
+            names = [name for name in self.changed.keys()
+                     if now - self.changed[name] >= debounce]
+            for name in names:
+                del self.changed[name]
+        return names
+
+    def discard(self, names, before):
+        # Forgets changes which were recorded before the given time, which a
+        # sync started at that time has picked up.  Changes recorded since
+        # then may be edits which the sync missed, so they are kept.
+        with self.lock:
+            for name in names:
+                if self.changed.get(name, before) < before:
+                    del self.changed[name]
+
+    def _changed(self, name):
+        with self.lock:
+            self.changed[name] = time()
+
+    def _startNotifier(self):
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE | \
+               pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB
+        manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(manager)
+        self.notifier.daemon = True
+        for project in self.projects:
+            def _event(event, name = project.name):
+                self._changed(name)
+            manager.add_watch(project.fullLocalPath(), mask, proc_fun = _event,
+                              rec = True, auto_add = True)
+        self.notifier.start()
+
+    def _poll(self):
+        snapshots = { }
+        for project in self.projects:
+            snapshots[project.name] = self._scan(project)
+        while True:
+            sleep(DaemonPollInterval)
+            for project in self.projects:
+                current = self._scan(project)
+                if current != snapshots[project.name]:
+                    self._changed(project.name)
+                snapshots[project.name] = current
+
+    def _scan(self, project):
+        try:
+            return snapshot.scan(project.fullLocalPath())
+        except OSError:
+            return None
+
+
 #------------------------------------------------------------------------------
 # Subroutines
 #------------------------------------------------------------------------------
@@ -908,6 +3601,7 @@ def ParseIniFile(fileName):
 
     ParseLocal(parser, config)
     ParseRemotes(parser, config)
+    ParseMirrors(parser, config)
 
     projects = []
     if config['local'].projects:
@@ -924,6 +3618,48 @@ def ParseIniFile(fileName):
     return config
 
 
+def ConfigCachePath():
+    return os.path.join(os.environ.get('HOME'), '.sync-config-cache')
+
+
+def ConfigCacheKey(fileName):
+    # The parsed configuration depends on the contents of the INI file, on the
+    # hostname (which selects the local) and on the definitions of the classes
+    # in this script.  If any of these change, the cache is discarded.
+    st = os.stat(fileName)
+    script = os.stat(os.path.abspath(__file__))
+    return (ConfigCacheVersion, os.path.abspath(fileName), st.st_mtime, st.st_size,
+            socket.gethostname(), script.st_mtime, script.st_size)
+
+
+def LoadConfig(fileName, options):
+    # Returns the parsed configuration, reusing the result of a previous parse
+    # of the same INI file if possible
+    if not options.cache:
+        return ParseIniFile(fileName)
+    try:
+        key = ConfigCacheKey(fileName)
+    except OSError:
+        raise IOError("Failed to read config file " + fileName)
+    filename = ConfigCachePath()
+    try:
+        with open(filename, 'rb') as f:
+            (cachedKey, config) = pickle.load(f)
+        if cachedKey == key:
+            return config
+    except Exception:
+        pass
+    config = ParseIniFile(fileName)
+    try:
+        tmp = filename + '.tmp.' + str(os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump((key, config), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+    except (IOError, OSError, pickle.PicklingError) as e:
+        PrintWarning("Failed to write config cache: " + str(e))
+    return config
+
+
 def ParseLocal(parser, config):
     config['hostname'] = socket.gethostname()
     for section in parser.sections():
@@ -950,7 +3686,22 @@ def ParseRemotes(parser, config):
                 raise IOError("Remote '" + name + "' has neither 'root' nor '" \
                                + host_root + "' property")
             scm_bare = ExtractOptionalIniFieldBool(parser, section, 'scm_bare', default=True)
-            config['remotes'][name] = Remote(name, root, scm_bare)
+            def _int(field, default):
+                value = ExtractOptionalIniField(parser, section, field, local=config['local'].name)
+                if value:
+                    return int(value)
+                return default
+            config['remotes'][name] = Remote(name, root, scm_bare,
+                                             _int('max_jobs', RemoteMaxJobs),
+                                             _int('retries', RemoteRetries),
+                                             _int('retry_delay', RemoteRetryDelay),
+                                             _int('max_failures', RemoteMaxFailures),
+                                             _int('bandwidth', 0),
+                                             ExtractChoiceIniField(parser, section, 'compress',
+                                                 ('auto', 'true', 'false'), config, 'auto'),
+                                             ExtractChoiceIniField(parser, section, 'engine',
+                                                 ('rsync', 'native'), config, 'rsync'),
+                                             _int('lease_ttl', 0))
         if section.startswith('remote-alias:'):
             name = section[13:]
             target = ExtractRequiredIniField(parser, section, 'target', local=config['local'].name)
@@ -962,6 +3713,36 @@ def ParseRemotes(parser, config):
             config['remotes'][name] = remote
 
 
+def ParseMirrors(parser, config):
+    # Mirrors are indexed by the name of the remote which they mirror
+    config['mirrors'] = { }
+    local = config['local'].name
+    for section in parser.sections():
+        if section.startswith('mirror:'):
+            name = section[7:]
+            remote = ExtractRequiredIniField(parser, section, 'remote', local=local)
+            if not remote in config['remotes']:
+                raise IOError("Mirror '" + name + "' refers to unknown remote '" + remote + "'")
+            if remote in config['mirrors']:
+                raise IOError("Remote '" + remote + "' has more than one mirror")
+            root = ExtractRequiredIniField(parser, section, 'root', local=local)
+            freshness = ExtractOptionalIniField(parser, section, 'freshness', local=local)
+            if freshness:
+                freshness = int(freshness)
+            else:
+                freshness = MirrorFreshness
+            config['mirrors'][remote] = Mirror(name, config['remotes'][remote], root, freshness)
+
+
+def ExtractChoiceIniField(parser, section, field, choices, config, default = None):
+    value = ExtractOptionalIniField(parser, section, field, local=config['local'].name)
+    if not value:
+        return default
+    if not value in choices:
+        raise IOError("Invalid value '" + value + "' for " + field + " in section '" + section + "'")
+    return value
+
+
 def ParseProjects(parser, names, config):
     config['projects'] = { }
     for name in names:
@@ -987,34 +3768,156 @@ def ParseProjectGroups(parser, config):
             project_list = ExtractRequiredIniField(parser, section, 'projects', local=config['local'].name)
             group = ProjectGroup(name)
             group.projects = project_list.split()
+            group.after = ParseDependencies(parser, section, 'after', group, config)
+            group.requires = ParseDependencies(parser, section, 'requires', group, config)
             config['project-groups'][name] = group
+    CheckDependencies(config['project-groups'].values())
 
 
-def OpenHistoryFile(mode):
+def ParseDependencies(parser, section, field, group, config):
+    # Dependencies are written as a list of entries of the form
+    #   project:predecessor[,predecessor...]
+    edges = { }
+    value = ExtractOptionalIniField(parser, section, field, local=config['local'].name)
+    if value:
+        for entry in value.split():
+            fields = entry.split(':')
+            if len(fields) != 2 or not fields[0] or not fields[1]:
+                raise IOError("Invalid dependency '" + entry + "' in section '" + section + "'")
+            names = [fields[0]] + fields[1].split(',')
+            for name in names:
+                if not name in group.projects:
+                    raise IOError("Project '" + name + "' in " + field + " of section '" +
+                                  section + "' is not a member of the group")
+            edges.setdefault(fields[0], []).extend(names[1:])
+    return edges
+
+
+def CheckDependencies(groups):
+    # Raises an error if the dependencies of all groups together form a cycle
+    edges = { }
+    for group in groups:
+        for dependencies in (group.after, group.requires):
+            for name in dependencies.keys():
+                edges.setdefault(name, set()).update(dependencies[name])
+    visited = set()
+    def _visit(name, path):
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise IOError("Cyclic dependency between projects: " + ' -> '.join(cycle))
+        if name in visited:
+            return
+        for predecessor in edges.get(name, []):
+            _visit(predecessor, path + [name])
+        visited.add(name)
+    for name in edges.keys():
+        _visit(name, [])
+
+
+def HistoryDatabasePath():
+    return os.path.join(os.environ.get('HOME'), '.sync-history.db')
+
+
+def OpenHistoryDatabase():
+    filename = HistoryDatabasePath()
+    exists = os.path.exists(filename)
+    database = sqlite3.connect(filename, timeout = 60)
+    with database:
+        database.execute('CREATE TABLE IF NOT EXISTS runs (' +
+                         'id INTEGER PRIMARY KEY, ' +
+                         'start INTEGER NOT NULL, ' +
+                         'end INTEGER, ' +
+                         'success INTEGER)')
+        # Set for sync runs; see History.beginRun
+        AddHistoryColumns(database, 'runs', ['remote TEXT', 'selection TEXT',
+                                             'host TEXT', 'pid INTEGER'])
+        database.execute('CREATE TABLE IF NOT EXISTS project_runs (' +
+                         'id INTEGER PRIMARY KEY, ' +
+                         'run INTEGER REFERENCES runs(id), ' +
+                         'project TEXT NOT NULL, ' +
+                         'operation TEXT NOT NULL, ' +
+                         'time INTEGER NOT NULL, ' +
+                         'duration REAL, ' +
+                         'bytes INTEGER, ' +
+                         'exit_code INTEGER, ' +
+                         'success INTEGER NOT NULL)')
+        database.execute('CREATE INDEX IF NOT EXISTS project_runs_project ' +
+                         'ON project_runs (project, time)')
+        database.execute('CREATE INDEX IF NOT EXISTS runs_start ON runs (start)')
+        database.execute('CREATE TABLE IF NOT EXISTS checkpoints (' +
+                         'run INTEGER NOT NULL REFERENCES runs(id), ' +
+                         'job TEXT NOT NULL, ' +
+                         'time INTEGER NOT NULL, ' +
+                         'success INTEGER NOT NULL)')
+        AddHistoryColumns(database, 'checkpoints', ['remote TEXT'])
+        database.execute('CREATE INDEX IF NOT EXISTS checkpoints_run ON checkpoints (run)')
+        if not exists:
+            ImportLegacyHistory(database)
+    return database
+
+
+def AddHistoryColumns(database, table, columns):
+    # Adds those of columns (given as 'name type') which a table created by
+    # an earlier version of this script lacks
+    existing = [row[1] for row in database.execute('PRAGMA table_info(' + table + ')')]
+    for column in columns:
+        if not column.split()[0] in existing:
+            database.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + column)
+
+
+def ImportLegacyHistory(database):
+    # Imports the last push/pull times from the whitespace-delimited
+    # ~/.sync-history file used by earlier versions of this script
     filename = os.path.join(os.environ.get('HOME'), '.sync-history')
-    file = None
-    try:
-        file = open(filename, mode)
-    finally:
-        return file
+    if not os.path.exists(filename):
+        return
+    def _times(last, lastSuccessful):
+        result = []
+        if last:
+            result.append((last, last == lastSuccessful))
+        if lastSuccessful and last != lastSuccessful:
+            result.append((lastSuccessful, True))
+        return result
+    with open(filename, 'r') as file:
+        for line in file.readlines():
+            tokens = line.split()
+            if not len(tokens) or tokens[0].startswith('#'):
+                continue
+            name = tokens.pop(0)
+            tokens = [int(token) for token in tokens]
+            if 'sync' == name:
+                for (start, success) in _times(tokens[0], tokens[1]):
+                    database.execute('INSERT INTO runs (start, success) VALUES (?, ?)',
+                                     (start, int(success)))
+            else:
+                for (operation, last, lastSuccessful) in \
+                        [('push', tokens[0], tokens[1]), ('pull', tokens[2], tokens[3])]:
+                    for (start, success) in _times(last, lastSuccessful):
+                        database.execute('INSERT INTO project_runs ' +
+                                         '(project, operation, time, success) ' +
+                                         'VALUES (?, ?, ?, ?)',
+                                         (name, operation, start, int(success)))
 
 
 def ReadHistory(config):
-    file = OpenHistoryFile('r')
-    history = History(config)
-    if file:
-        history.read(file)
-    return history
+    database = None
+    try:
+        database = OpenHistoryDatabase()
+    except sqlite3.Error as e:
+        PrintError("Opening history database failed: " + str(e))
+    return History(config, database)
 
 
 def WriteHistory(history):
     success = False
-    file = OpenHistoryFile('w')
-    if file:
-        history.write(file)
-        success = True
-    else:
-        PrintError("Writing history file failed")
+    try:
+        if history.database:
+            history.write()
+            success = True
+    except sqlite3.Error as e:
+        PrintError(str(e))
+    if not success:
+        PrintError("Writing history failed")
     return success
 
 
@@ -1027,7 +3930,13 @@ def CreateGitProject(parser, name, auto, config):
     remote_path = ExtractRequiredIniField(parser, section, 'remote_path', local=local.name)
     branches = ExtractOptionalIniField(parser, section, 'branches', local=local.name)
     direction = ExtractOptionalIniField(parser, section, 'direction', local=local.name)
-    return GitProject(name, auto, direction, local, local_path, default_remote, remote_path, branches)
+    clone_depth = ExtractOptionalIniField(parser, section, 'clone_depth', local=local.name)
+    if clone_depth:
+        clone_depth = int(clone_depth)
+    clone_filter = ExtractOptionalIniField(parser, section, 'clone_filter', local=local.name)
+    reference = ExtractOptionalIniField(parser, section, 'reference', local=local.name)
+    return GitProject(name, auto, direction, local, local_path, default_remote, remote_path, branches,
+                      clone_depth, clone_filter, reference)
 
 
 def CreateHgProject(parser, name, auto, config):
@@ -1051,7 +3960,10 @@ def CreateRsyncProject(parser, name, auto, config):
     remote_path = ExtractRequiredIniField(parser, section, 'remote_path', local=local.name)
     direction = ExtractOptionalIniField(parser, section, 'direction', local=local.name)
     rsync_options = ExtractOptionalIniField(parser, section, 'rsync_options', local=local.name)
-    return RsyncProject(name, auto, direction, local,local_path, default_remote, remote_path, rsync_options)
+    compress = ExtractChoiceIniField(parser, section, 'compress', ('auto', 'true', 'false'), config)
+    engine = ExtractChoiceIniField(parser, section, 'engine', ('rsync', 'native'), config)
+    return RsyncProject(name, auto, direction, local,local_path, default_remote, remote_path,
+                        rsync_options, compress, engine)
 
 
 def CreateUnisonProject(parser, name, auto, config):
@@ -1085,6 +3997,7 @@ def CreateCommandLineParser():
     usage += "\n  status [projects ...]     Get current project status"
     usage += "\n  history [projects ...]    Get time and outcome of previous syncs"
     usage += "\n  sync [projects ...]       Perform synchronisation"
+    usage += "\n  verify [projects ...]     Compare digests of local and remote files"
     parser.set_usage(usage)
     parser.add_option('-i', '--ini', type='string', dest='ini_filename',
                       help='INI file name')
@@ -1103,6 +4016,38 @@ def CreateCommandLineParser():
                       help="Name of remote")
     parser.add_option('-p', '--prefer', dest='prefer',
                       help="Which copy to prefer in case of conflict (local|remote)")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='Number of projects to synchronise concurrently')
+    parser.add_option('-f', '--force', dest='force', action='store_true',
+                      default=False, help='Synchronise projects even if they are up to date')
+    parser.add_option('--lease-wait', dest='lease_wait', type='int', default=0, metavar='SECONDS',
+                      help='Seconds to wait for a remote lease held by another host (see lease_ttl)')
+    parser.add_option('--reference', dest='reference', metavar='DIR',
+                      help='Seed git clones made by init from local mirrors under DIR')
+    parser.add_option('--daemon', dest='daemon', action='store_true', default=False,
+                      help='Run sync as a daemon which watches local projects for changes')
+    parser.add_option('--stop-daemon', dest='stop_daemon', action='store_true', default=False,
+                      help='Stop the sync daemon')
+    parser.add_option('--foreground', dest='foreground', action='store_true', default=False,
+                      help='Run the sync daemon without forking into the background')
+    parser.add_option('--pidfile', dest='pid_file', metavar='FILE',
+                      help='PID file of the sync daemon (default ~/.sync-daemon.pid)')
+    parser.add_option('--log', dest='log', metavar='FILE',
+                      help='Log file of the sync daemon (default ~/.sync-daemon.log)')
+    parser.add_option('--debounce', dest='debounce', type='int', default=DaemonDebounce,
+                      help='Seconds for which a project must be unchanged before the daemon synchronises it')
+    parser.add_option('--reconcile', dest='reconcile', type='int', default=DaemonReconcileInterval,
+                      help='Seconds between synchronisations of all projects by the daemon')
+    parser.add_option('--format', dest='format', type='choice', choices=['text', 'json'],
+                      default='text', help='Output format: text (default) or json')
+    parser.add_option('--metrics', dest='metrics', metavar='FILE',
+                      help='Append timing and throughput records to FILE, as JSON lines')
+    parser.add_option('--resume', dest='resume', action='store_true', default=False,
+                      help='Skip projects which were synchronised by an interrupted run')
+    parser.add_option('--no-cache', dest='cache', action='store_false',
+                      default=True, help='Do not use the cached configuration')
+    parser.add_option('--no-multiplex', dest='multiplex', action='store_false',
+                      default=True, help='Do not share ssh connections between commands')
 
     return parser
 
@@ -1147,9 +4092,11 @@ def GetProjects(action, args, config):
             if -1 != index:
                 project = project[0:index]
             if project in config['projects'].keys():
-                result.append(entry)
+                if not entry in result:
+                    result.append(entry)
             elif project in config['project-groups'].keys():
-                result += config['project-groups'][entry].projects
+                # Groups may overlap
+                result += [x for x in config['project-groups'][entry].projects if not x in result]
             else:
                 raise IOError("'" + entry + "' does not refer to a project or project group")
     return result
@@ -1163,6 +4110,20 @@ def GetProjects(action, args, config):
 
 def ActionList(commandLine, config):
     commandLine['args'].pop(0)
+    if report.enabled():
+        def _objects(objects):
+            return dict([(name, ObjectToJson(objects[name])) for name in objects.keys()])
+        report.write({
+            'action': 'list',
+            'ini_filename': commandLine['options'].ini_filename,
+            'hostname': config['hostname'],
+            'local': ObjectToJson(config['local']),
+            'remotes': _objects(config['remotes']),
+            'mirrors': dict([(x.name, ObjectToJson(x)) for x in config['mirrors'].values()]),
+            'projects': _objects(config['projects']),
+            'project_groups': _objects(config['project-groups'])
+        })
+        return True
     ruler = '-----------------------------------------------------------------------'
     print()
     print("INI filename:     " + commandLine['options'].ini_filename)
@@ -1179,6 +4140,13 @@ def ActionList(commandLine, config):
     print(ruler)
     for name in config['remotes'].keys():
         print("\n", config['remotes'][name])
+    if len(config['mirrors']):
+        print()
+        print(ruler)
+        print("Mirrors")
+        print(ruler)
+        for mirror in config['mirrors'].values():
+            print("\n", mirror)
     print()
     print(ruler)
     print("Projects")
@@ -1203,12 +4171,37 @@ def PrintResults(timer, result):
         for name in result.keys():
             formatString = "%(name)-" + str(nameWidth) + "s : "
             sys.stdout.write(formatString % {'name' : name})
-            if result[name]:
+            if result[name] == Status.UpToDate:
+                PrintToConsole('up to date', Color.GREEN)
+            elif result[name] == Status.Skipped:
+                PrintToConsole('skipped', Color.YELLOW)
+            elif result[name]:
                 PrintToConsole('OK', Color.GREEN)
             else:
                 PrintToConsole('FAILED', Color.RED)
             sys.stdout.write('\n')
 
+def ReportResults(action, start, success, projects):
+    report.write({
+        'action': action,
+        'success': bool(success),
+        'start': start,
+        'duration': round(time() - start, 3),
+        'projects': projects
+    })
+
+
+def StartSshMultiplexer(projects, options, config):
+    if not options.multiplex:
+        return
+    targets = []
+    for project in projects:
+        target = project.sshTarget(project.getRemote(options, config))
+        if target:
+            targets.append(target)
+    sshMux.start(targets, options)
+
+
 def printLocal(config):
     PrintToConsole("Local\n\n", Color.GREEN)
     print(config['local'])
@@ -1228,33 +4221,51 @@ def ActionInit(commandLine, config):
 
     overallTimer = DurationTimer('Sync')
     result = {}
+    projectResults = {}
     printLocal(config)
 
-    success = True
+    # Clones are limited by the network and by the remotes rather than by
+    # local CPU, so more projects are initialised at once than are synced.
+    # In a dry run, the commands are printed one project at a time.
+    maxJobs = max(options.jobs, InitMaxJobs)
+    if options.dry_run:
+        maxJobs = 1
+    scheduler = Scheduler(maxJobs)
     for name in projectNames:
         project = config['projects'][name]
-        if os.path.exists(project.local_path):
+        if os.path.exists(project.fullLocalPath()):
             PrintToConsole("\nSkipping project '" + project.name + "' [" + project.type + "]\n", \
                Color.CYAN)
-            print("Local path '" + project.local_path + "' already exists")
+            print("Local path '" + project.fullLocalPath() + "' already exists")
         else:
-            PrintToConsole("\nInitialising project '" + project.name + "' [" + project.type + "] ...\n\n", \
-                           Color.GREEN)
-            printProject(project, options, config)
-            try:
-                timer = DurationTimer("Initialization of project '" + name + "'")
-                projectSuccess = project.init(history, options, config)
-                result[name] = projectSuccess
-                success &= projectSuccess
-                print(timer)
-            except Exception as e:
-                print(e)
-                result[name] = False
-                success = False
+            scheduler.add(Job(name, project, '', project.getRemote(options, config)))
+
+    def doInit(job, history):
+        PrintToConsole("\nInitialising project '" + job.project.name + "' [" + job.project.type + "] ...\n\n", \
+                       Color.GREEN)
+        printProject(job.project, options, config)
+        timer = DurationTimer("Initialization of project '" + job.project.name + "'")
+        success = job.project.init(history, options, config)
+        print(timer)
+        return success
+
+    def finishInit(job):
+        result[job.name] = job.success
+        if job.skipped:
+            result[job.name] = Status.Skipped
+        projectResults[job.name] = { 'status': StatusNames[int(result[job.name])],
+                                     'duration': round(job.end - job.start, 3) }
+
+    with metrics.phase('remote_connect'):
+        StartSshMultiplexer([job.project for job in scheduler.jobs], options, config)
+    success = scheduler.run(history, doInit, finishInit)
+    sshMux.release()
 
     history.setLastRun(now, success)
-    success &= WriteHistory(history)
+    with metrics.phase('history_write'):
+        success &= WriteHistory(history)
     PrintResults(overallTimer, result)
+    ReportResults('init', now, success, projectResults)
     return success
 
 
@@ -1263,13 +4274,40 @@ def ActionSync(commandLine, config):
     now = int(time())
     options = commandLine['options']
 
+    if options.remote and not options.remote in config['remotes'].keys():
+        PrintError("Remote '" + options.remote + "' not found")
+        return False
+
     projectNames = GetProjects('sync', commandLine['args'], config)
+    mirrorUpdater.reset()
+
+    # Jobs which were completed by an interrupted run with the same remote
+    # and selection of projects are not repeated
+    remoteName = options.remote or ''
+    selection = ' '.join(sorted(commandLine['args']))
+    if options.all:
+        selection = ('--all ' + selection).strip()
+    completed = set()
+    if options.resume and history.database:
+        try:
+            completed = history.resumableJobs(remoteName, selection)
+        except IOError as e:
+            PrintError(str(e))
+            return False
+        if completed is None:
+            PrintWarning("The last sync run of the same projects was not interrupted; nothing to resume")
+            completed = set()
 
     overallTimer = DurationTimer('Sync')
     result = {}
+    projectResults = {}
     printLocal(config)
 
-    success = True
+    checkpoint = not options.dry_run
+    if checkpoint:
+        history.beginRun(now, remoteName, selection)
+
+    scheduler = Scheduler(options.jobs)
     for value in projectNames:
         name = value
         subdir = ''
@@ -1278,46 +4316,416 @@ def ActionSync(commandLine, config):
             name = value[0:index]
             subdir = value[index+1:]
         project = config['projects'][name]
-        if len(commandLine['args']) or project.auto or commandLine['options'].all:
-            PrintToConsole("\nSynchronising project '" + name + "' [" + project.type + "] ...\n\n", \
-                           Color.GREEN)
-            printProject(project, options, config)
-            try:
-                timer = DurationTimer("Sync of project '" + name + "'")
-                projectSuccess = project.sync(history, options, subdir)
-                result[name] = projectSuccess
-                success &= projectSuccess
-                print(timer)
-            except Exception as e:
-                print(e)
-                result[name] = False
-                success = False
+        remote = project.getRemote(options, config)
+        if (value, remote.name) in completed:
+            PrintToConsole("\nSkipping project '" + value + "' [" + project.type + "] - completed by interrupted run\n", \
+               Color.CYAN)
+            if checkpoint:
+                history.checkpoint(value, remote.name, True)
+            result[name] = Status.Ok
+            projectResults[value] = { 'status': StatusNames[Status.Ok], 'resumed': True }
+        elif len(commandLine['args']) or project.auto or commandLine['options'].all:
+            scheduler.add(Job(value, project, subdir, remote))
         else:
             PrintToConsole("\nSkipping project '" + name + "' [" + project.type + "] - auto flag not set\n", \
                Color.CYAN)
+    scheduler.addDependencies(config['project-groups'].values())
+    if history.database:
+        for job in scheduler.jobs:
+            if job.project.bandwidthLimited:
+                job.project.throughput = history.throughput(job.project.name)
+
+    def doSync(job, history):
+        PrintToConsole("\nSynchronising project '" + job.project.name + "' [" + job.project.type + "] ...\n\n", \
+                       Color.GREEN)
+        printProject(job.project, options, config)
+        timer = DurationTimer("Sync of project '" + job.project.name + "'")
+        # Remote refs are listed before any project runs, so they may be out
+        # of date if a project which ran before this one used the same remote
+        ran = [x for x in job.predecessors() if x.remote.root == job.remote.root
+               and not x.upToDate and not x.skipped]
+        if not options.force and not ran and job.project.upToDate(options, config):
+            print("Project '" + job.project.name + "' is up to date")
+            job.project.setUpToDate(history, int(time()), options)
+            job.upToDate = True
+            return True
+        lease = None
+        if not options.dry_run:
+            lease = job.project.lease(job.remote)
+        if lease:
+            try:
+                if not lease.acquire(options.lease_wait):
+                    job.skipped = True
+                    return False
+            except IOError as e:
+                PrintError(str(e))
+                return False
+        try:
+            success = job.project.sync(history, options, job.subdir)
+        finally:
+            if lease:
+                lease.release()
+        if lease and lease.lost:
+            # Another host may have synchronised the project at the same time
+            PrintError("Project '" + job.project.name + "' was synchronised without a lease")
+            success = False
+        print(timer)
+        return success
+
+    def finishSync(job):
+        remote = job.remote
+        fields = dict(project_type=job.project.type, remote=remote.name,
+                      host=remote.root, success=bool(job.success),
+                      up_to_date=job.upToDate, skipped=job.skipped,
+                      duration=round(job.end - job.start, 3),
+                      bytes=job.bytes, files=job.files)
+        metrics.record('project', project=job.name, **fields)
+        if job.skipped:
+            result[job.project.name] = Status.Skipped
+        elif job.upToDate:
+            result[job.project.name] = Status.UpToDate
+        else:
+            result[job.project.name] = job.success
+        fields['status'] = StatusNames[int(result[job.project.name])]
+        projectResults[job.name] = fields
+        if checkpoint:
+            history.checkpoint(job.name, job.remote.name, job.success)
+
+    with metrics.phase('remote_connect'):
+        StartSshMultiplexer([job.project for job in scheduler.jobs], options, config)
+    if not options.force and options.dry_run < 2:
+        with metrics.phase('ref_check'):
+            refCache.prefetch([job.project for job in scheduler.jobs], options, config)
+    success = scheduler.run(history, doSync, finishSync)
+    sshMux.release()
 
     history.setLastRun(now, success)
-    success &= WriteHistory(history)
+    with metrics.phase('history_write'):
+        success &= WriteHistory(history)
     PrintResults(overallTimer, result)
+    ReportResults('sync', now, success, projectResults)
     return success
 
 
+def PrintTable(header, rows, colors, left):
+    # Prints each row in the corresponding colour.  Columns whose indices are
+    # in left are left-aligned, and the others right-aligned; the last column
+    # is printed without alignment or colour.
+    widths = [max([len(row[i]) for row in rows + [header]]) for i in range(len(header))]
+    def _format(row):
+        fields = []
+        for i in range(len(header) - 1):
+            if i in left:
+                fields.append(row[i].ljust(widths[i]))
+            else:
+                fields.append(row[i].rjust(widths[i]))
+        return '  '.join(fields) + '  '
+
+    PrintToConsole(_format(header) + header[-1] + '\n', Color.CYAN)
+    for row, color in zip(rows, colors):
+        PrintToConsole(_format(row), color)
+        sys.stdout.write(row[-1] + '\n')
+
+
+def TableColor(result):
+    if result.error:
+        return Color.RED
+    if not result.clean():
+        return Color.YELLOW
+    return Color.GREEN
+
+
+def PrintStatusTable(statuses, options):
+    def _count(value):
+        if value is None:
+            return '-'
+        return str(value)
+
+    statuses = [x for x in statuses if not (options.quiet and x.clean())]
+    rows = []
+    for status in statuses:
+        rows.append([status.name, status.type, status.branch or '',
+                     _count(status.changes), _count(status.ahead),
+                     _count(status.behind), status.error or status.note or ''])
+    # Name and branch columns are left-aligned, counts are right-aligned
+    PrintTable(['Project', 'Type', 'Branch', 'Changes', 'Ahead', 'Behind', 'Notes'],
+               rows, [TableColor(x) for x in statuses], (0, 1, 2))
+
+
+def FormatBytes(count):
+    # Returns a byte count as a short human-readable string
+    if count is None:
+        return '-'
+    value = float(count)
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if value < 1024:
+            break
+        value /= 1024
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return str(count) + ' B'
+    return '%.1f %s' % (value, unit)
+
+
+def PrintPlanTable(plans, options):
+    def _count(value):
+        if value is None:
+            return '-'
+        return str(value)
+
+    def _total(values):
+        # Values which could not be determined are left out
+        return sum([x for x in values if x is not None])
+
+    plans = [x for x in plans if not (options.quiet and x.clean())]
+    rows = []
+    for plan in plans:
+        rows.append([plan.name, plan.type, _count(plan.push), FormatBytes(plan.pushBytes),
+                     _count(plan.pull), FormatBytes(plan.pullBytes),
+                     plan.error or plan.note or ''])
+    rows.append(['Total', '', str(_total([x.push for x in plans])),
+                 FormatBytes(_total([x.pushBytes for x in plans])),
+                 str(_total([x.pull for x in plans])),
+                 FormatBytes(_total([x.pullBytes for x in plans])), ''])
+    PrintTable(['Project', 'Type', 'Push', 'Push size', 'Pull', 'Pull size', 'Notes'],
+               rows, [TableColor(x) for x in plans] + [Color.CYAN], (0, 1))
+
+
+def PrintVerifyTable(results, options):
+    results = [x for x in results if not (options.quiet and x.clean())]
+    rows = []
+    for result in results:
+        rows.append([result.name, result.type, str(result.files), str(result.hashed),
+                     str(len(result.differ)), str(len(result.localOnly)),
+                     str(len(result.remoteOnly)), result.error or result.note or ''])
+    PrintTable(['Project', 'Type', 'Files', 'Hashed', 'Differ', 'Local only',
+                'Remote only', 'Notes'],
+               rows, [TableColor(x) for x in results], (0, 1))
+
+    for result in results:
+        if result.clean():
+            continue
+        PrintToConsole("\n" + result.name + "\n", Color.YELLOW)
+        for (label, paths) in (('differs', result.differ),
+                               ('local only', result.localOnly),
+                               ('remote only', result.remoteOnly)):
+            for path in paths:
+                print('    ' + label.ljust(14) + path)
+
+
+def ActionSyncDaemon(commandLine, config):
+    # Imported here because the module installs exit handlers
+    from metasystem import daemon
+    import metasystem
+
+    options = commandLine['options']
+    pidFile = options.pid_file or os.path.join(os.environ.get('HOME'), '.sync-daemon.pid')
+    umask = os.umask(0)
+    os.umask(umask)
+
+    class SyncDaemon(daemon.Daemon):
+        # Watches the local trees of the selected projects, and synchronises
+        # each one once it has stopped changing.  All projects are also
+        # synchronised periodically, to pick up changes made on remotes.
+        # Configuration and ssh connections are kept between runs.
+        def run(self):
+            # The daemon clears the umask when it forks
+            os.umask(umask)
+            projectNames = GetProjects('sync', commandLine['args'], config)
+            projects = []
+            for name in projectNames:
+                project = config['projects'][name.split('/')[0]]
+                if len(commandLine['args']) or project.auto or options.all:
+                    if not project in projects:
+                        projects.append(project)
+            if not len(projects):
+                PrintError('No projects to watch')
+                return
+            sshMux.persistent = True
+            watcher = TreeWatcher(projects)
+            watcher.start()
+            names = [project.name for project in projects]
+            configKey = ConfigCacheKey(options.ini_filename)
+            nextReconcile = 0
+            while True:
+                if time() >= nextReconcile:
+                    changed = names
+                    nextReconcile = time() + options.reconcile
+                    if ConfigCacheKey(options.ini_filename) != configKey:
+                        PrintWarning("'" + options.ini_filename + "' has changed; " +
+                                     "restart the daemon to apply the changes")
+                else:
+                    changed = watcher.changes(options.debounce)
+                if len(changed):
+                    start = time()
+                    self._sync(changed)
+                    # Changes made while the sync ran, including any made by
+                    # the sync itself, cause another sync once they settle
+                    watcher.discard(changed, start)
+                sys.stdout.flush()
+                sleep(1)
+
+        def _sync(self, names):
+            print('\n' + FormatKeyValue('Synchronising', ' '.join(names)) + '\n')
+            circuitBreaker.reset()
+            try:
+                ActionSync({ 'command': 'sync', 'args': list(names), 'options': options },
+                           config)
+            except Exception as e:
+                PrintError(str(e))
+
+    log = options.log or os.path.join(os.environ.get('HOME'), '.sync-daemon.log')
+    instance = SyncDaemon(os.path.abspath(pidFile), stdout=os.path.abspath(log),
+                          stderr=os.path.abspath(log), fg=options.foreground,
+                          exit_parent=True)
+    if options.stop_daemon:
+        instance.stop()
+        return True
+    # The daemon changes directory to /
+    options.ini_filename = os.path.abspath(options.ini_filename)
+    try:
+        instance.start()
+    except metasystem.DaemonError as e:
+        PrintError(str(e))
+        return False
+    return True
+
+
 def ActionStatus(commandLine, config):
+    options = commandLine['options']
     projectNames = GetProjects('status', commandLine['args'], config)
+    projects = [config['projects'][name] for name in projectNames]
 
-    success = True
-    for name in projectNames:
+    # Status is collected for all projects concurrently.  Projects which use
+    # a remote are queried via shared ssh connections.
+    StartSshMultiplexer(projects, options, config)
+    refCache.prefetch(projects, options, config)
+
+    def collect(project):
+        try:
+            return project.collectStatus(options, config)
+        except Exception as e:
+            status = ProjectStatus(project)
+            status.error = str(e)
+            return status
+
+    statuses = RunConcurrently(collect, projects, max(options.jobs, StatusMaxJobs))
+    sshMux.release()
+
+    if report.enabled():
+        report.write({
+            'action': 'status',
+            'success': not [x for x in statuses if x.error],
+            'projects': dict([(x.name, ObjectToJson(x)) for x in statuses])
+        })
+    else:
+        PrintStatusTable(statuses, options)
+
+    # In verbose mode, the output of the native status command is also
+    # shown for each project which has local changes
+    if options.verbose:
+        for project, status in zip(projects, statuses):
+            if status.changes:
+                print("\nStatus of project '" + project.name + "' [" + project.type + "] ...")
+                project.status(options)
+
+    return not [x for x in statuses if x.error]
+
+
+def ActionSyncPlan(commandLine, config):
+    # 'sync -n' works out what a sync would transfer for all projects
+    # concurrently, and prints the result as a single plan
+    options = commandLine['options']
+
+    if options.remote and not options.remote in config['remotes'].keys():
+        PrintError("Remote '" + options.remote + "' not found")
+        return False
+
+    timer = DurationTimer('Plan')
+    selected = []
+    for value in GetProjects('sync', commandLine['args'], config):
+        (name, separator, subdir) = value.partition('/')
         project = config['projects'][name]
-        if not commandLine['options'].quiet:
-            print("\nStatus of project '" + name + "' [" + project.type + "] ...")
-        success &= project.status(commandLine['options'])
+        if len(commandLine['args']) or project.auto or options.all:
+            selected.append((value, project, subdir))
+
+    projects = [x[1] for x in selected]
+    StartSshMultiplexer(projects, options, config)
+    refCache.prefetch(projects, options, config)
+
+    def plan(item):
+        (value, project, subdir) = item
+        try:
+            result = project.plan(options, config, subdir)
+        except Exception as e:
+            result = ProjectPlan(project)
+            result.error = str(e)
+        result.name = value
+        return result
+
+    plans = RunConcurrently(plan, selected, max(options.jobs, StatusMaxJobs))
+    sshMux.release()
+
+    success = not [x for x in plans if x.error]
+    if report.enabled():
+        report.write({
+            'action': 'sync',
+            'dry_run': True,
+            'success': success,
+            'projects': dict([(x.name, ObjectToJson(x)) for x in plans])
+        })
+    else:
+        PrintPlanTable(plans, options)
+        print(timer)
+
+    return success
+
+
+def ActionVerify(commandLine, config):
+    options = commandLine['options']
+    projectNames = GetProjects('verify', commandLine['args'], config)
+    projects = [config['projects'][name] for name in projectNames]
+
+    # Hashing is limited by disk bandwidth, so only --jobs projects are
+    # verified at once
+    StartSshMultiplexer(projects, options, config)
+
+    def verify(project):
+        try:
+            return project.verify(options, config)
+        except Exception as e:
+            result = ProjectVerification(project)
+            result.error = str(e)
+            return result
+
+    results = RunConcurrently(verify, projects, options.jobs)
+    sshMux.release()
+
+    success = not [x for x in results if not x.clean()]
+    if report.enabled():
+        report.write({
+            'action': 'verify',
+            'success': success,
+            'projects': dict([(x.name, ObjectToJson(x)) for x in results])
+        })
+    else:
+        PrintVerifyTable(results, options)
+
     return success
 
 
 def ActionHistory(commandLine, config):
     commandLine['args'].pop(0)
     history = ReadHistory(config)
-    history.printToConsole()
+    if not history.database:
+        return False
+    if report.enabled():
+        document = history.toJson()
+        document['action'] = 'history'
+        report.write(document)
+    else:
+        history.printToConsole()
     return True
 
 
@@ -1328,22 +4736,54 @@ def ActionHistory(commandLine, config):
 check_env()
 
 commandLine = ProcessCommandLine()
-config = ParseIniFile(commandLine['options'].ini_filename)
+
+if commandLine['options'].daemon:
+    # Output goes to the daemon's log file
+    sys.stdout = OutputRouter(sys.__stdout__, colour = False)
+elif commandLine['options'].format == 'json':
+    # Only the JSON document is written to standard output.  Commands run
+    # by the script inherit file descriptor 1, so it is redirected to
+    # standard error, and the document is written to a duplicate of it.
+    sys.stdout.flush()
+    report.open(os.fdopen(os.dup(1), 'w'))
+    os.dup2(2, 1)
+    sys.stdout = OutputRouter(sys.__stderr__, colour = False)
+else:
+    sys.stdout = OutputRouter(sys.stdout)
 
 commandLine['command'] = 'sync'
 
 if len(commandLine['args']):
     commandLine['command'] = commandLine['args'][0]
 
+runStart = time()
+if commandLine['options'].metrics:
+    metrics.open(commandLine['options'].metrics, commandLine['command'])
+
+with metrics.phase('config_parse'):
+    config = LoadConfig(commandLine['options'].ini_filename, commandLine['options'])
+
 dispatch = {
                 'init':     ActionInit
            ,    'list':     ActionList
            ,    'sync':     ActionSync
            ,    'status':   ActionStatus
            ,    'history':  ActionHistory
+           ,    'verify':   ActionVerify
            }
 
-success = dispatch.get(commandLine['command'], ActionSync)(commandLine, config)
+action = dispatch.get(commandLine['command'], ActionSync)
+if commandLine['options'].daemon or commandLine['options'].stop_daemon:
+    if action != ActionSync:
+        PrintError("--daemon is only valid for 'sync'")
+        exit(1)
+    action = ActionSyncDaemon
+elif action == ActionSync and commandLine['options'].dry_run == 1:
+    action = ActionSyncPlan
+
+success = action(commandLine, config)
+
+metrics.record('run', success=bool(success), duration=round(time() - runStart, 3))
 
 exitCode = 0
 if not success:
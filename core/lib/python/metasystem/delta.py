@@ -0,0 +1,263 @@
+"""
+This module copies directory trees in-process, for destinations which are
+reachable via the local file system.  Files are compared by size and mtime.
+As with rsync, files which differ are written to a temporary file which then
+replaces the destination; with inplace, files which are already present at
+the destination are instead updated in place by rewriting only the blocks
+which differ.  Copies are always buffered by Python.
+"""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import stat
+
+from metasystem import hashcache
+from metasystem import snapshot
+
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+BLOCK_SIZE = 128 * 1024
+
+_COPY_CHUNK = 1024 * 1024
+
+
+#------------------------------------------------------------------------------
+# Stats
+#------------------------------------------------------------------------------
+
+class Stats(object):
+    """
+    Summary of a transfer.  bytes is the amount of data written to the
+    destination or, in a dry run, the size of the files which would be
+    copied; files is the number of files, links and directories created or
+    updated.  skipped lists the special files (FIFOs, sockets and device
+    nodes) which were not transferred.
+    """
+
+    def __init__(self):
+
+        self.files = 0
+        self.bytes = 0
+        self.deleted = 0
+        self.paths = []
+        self.skipped = []
+
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+
+def _differs(src, dst, entry, other, checksum):
+
+    if other is None or entry[0] != other[0]:
+        return True
+    if entry[0] == snapshot._DIR:
+        return False
+    if entry[0] == snapshot._LINK:
+        # The mtime of a link cannot be set, so its target is compared instead
+        return os.readlink(src) != os.readlink(dst)
+    if entry[1] != other[1]:
+        return True
+    # Whole seconds only, since not all file systems store more
+    return checksum or entry[2] // 1000000000 != other[2] // 1000000000
+
+
+def _copy_file(src, dst, st):
+    """
+    Copies a whole file via a temporary file, which is given the mode and
+    times of src before it replaces dst.  A reader therefore never sees a
+    partially written destination, and other hard links to dst, which may
+    itself be read-only, are left unchanged.
+    """
+
+    tmp = os.path.join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.delta-tmp')
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(tmp, 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst, _COPY_CHUNK)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, dst)
+    except:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return st.st_size
+
+
+def _update_file(src, dst, size, block_size):
+    """
+    Rewrites, in place, the blocks of dst which differ from those of src.
+    Returns the number of bytes written.
+    """
+
+    written = 0
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'r+b') as fdst:
+            offset = 0
+            while offset < size:
+                a = fsrc.read(block_size)
+                b = fdst.read(block_size)
+                if a != b:
+                    fdst.seek(offset)
+                    fdst.write(a)
+                    written += len(a)
+                offset += len(a)
+                fdst.seek(offset)
+            fdst.truncate(size)
+    return written
+
+
+def _same_content(src, dst, block_size):
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'rb') as fdst:
+            while True:
+                a = fsrc.read(block_size)
+                if a != fdst.read(block_size):
+                    return False
+                if not a:
+                    return True
+
+
+def _same_digest(hashes, name, src, dst, entry, other):
+
+    if other is None or entry[0] != snapshot._FILE or other[0] != snapshot._FILE:
+        return False
+    if entry[1] != other[1]:
+        return False
+    return hashes[0].digest(name, src, hashcache.entry_key(entry)) == \
+           hashes[1].digest(name, dst, hashcache.entry_key(other))
+
+
+def _remove(path):
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _transfer(src, dst, entry, other, st, block_size, inplace, compare):
+
+    kind = entry[0]
+    written = 0
+    if other is not None and other[0] != kind:
+        _remove(dst)
+        other = None
+    if kind == snapshot._DIR:
+        if other is None:
+            os.makedirs(dst)
+    elif kind == snapshot._LINK:
+        if other is not None:
+            os.remove(dst)
+        os.symlink(os.readlink(src), dst)
+        return 0
+    elif inplace and other is not None and other[1] != 0 and st.st_size >= block_size:
+        written = _update_file(src, dst, st.st_size, block_size)
+    elif not (compare and other is not None and other[1] == st.st_size and
+              _same_content(src, dst, block_size)):
+        return _copy_file(src, dst, st)
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, (st.st_atime, st.st_mtime))
+    return written
+
+
+#------------------------------------------------------------------------------
+# Public functions
+#------------------------------------------------------------------------------
+
+def sync_tree(src, dst, paths=None, delete=False, checksum=False,
+              dry_run=False, block_size=BLOCK_SIZE, hashes=None, inplace=False):
+    """
+    Makes the tree under dst match that under src, and returns a Stats.
+
+    If paths is given, only those paths (relative to src) are considered.
+    Entries under dst which are not present under src are removed only if
+    delete is set and paths is not.  If checksum is set, files whose size
+    and mtime match are also compared block by block.  If dry_run is set,
+    the paths which would be transferred are listed in the Stats, but
+    nothing is written.  If inplace is set, files which are already present
+    at dst are updated in place, as with rsync --inplace, rather than
+    replaced.
+
+    hashes is an optional pair of HashCaches for src and dst.  If checksum
+    is set, files whose sizes match are compared by digest, so that files
+    which are unmodified on both sides since they were last hashed are not
+    read.
+    """
+
+    stats = Stats()
+    source = snapshot.scan(src)
+    target = snapshot.scan(dst) if os.path.isdir(dst) else snapshot.Snapshot()
+    names = sorted(source.entries.keys())
+    if paths is not None:
+        wanted = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            # Parent directories must also exist at the destination
+            while path and path != '.':
+                wanted.add(path)
+                path = os.path.dirname(path)
+        names = [name for name in names if name in wanted]
+
+    if not dry_run and not os.path.isdir(dst):
+        os.makedirs(dst)
+
+    # Parents sort before their children, so directories are created first
+    for name in names:
+        entry = source.entries[name]
+        other = target.entries.get(name)
+        srcpath = os.path.join(src, name)
+        dstpath = os.path.join(dst, name)
+        if entry[0] == snapshot._SPECIAL:
+            # Opening a FIFO would block, so, as with rsync without
+            # --specials and --devices, special files are not transferred
+            stats.skipped.append(name)
+            continue
+        if not _differs(srcpath, dstpath, entry, other, checksum):
+            continue
+        if checksum and hashes and _same_digest(hashes, name, srcpath, dstpath, entry, other):
+            continue
+        if dry_run:
+            stats.paths.append(name)
+            stats.files += 1
+            if entry[0] == snapshot._FILE:
+                stats.bytes += entry[1]
+            continue
+        st = os.lstat(srcpath)
+        # Without cached digests, files whose sizes match are compared before
+        # being copied
+        written = _transfer(srcpath, dstpath, entry, other, st, block_size, inplace,
+                            checksum and not hashes)
+        if written or other is None or entry[0] != snapshot._FILE or not checksum:
+            stats.paths.append(name)
+            stats.files += 1
+            stats.bytes += written
+
+    # As with rsync --files-from, nothing is deleted if paths is given
+    if delete and paths is None:
+        for name in sorted(source.deleted(target), reverse=True):
+            if not dry_run:
+                _remove(os.path.join(dst, name))
+            stats.deleted += 1
+            stats.paths.append('deleting ' + name)
+
+    # Directory mtimes change as their contents are updated, so they are
+    # restored afterwards, deepest first
+    if not dry_run:
+        for name in reversed(names):
+            if source.entries[name][0] == snapshot._DIR:
+                st = os.lstat(os.path.join(src, name))
+                os.utime(os.path.join(dst, name), (st.st_atime, st.st_mtime))
+
+    return stats
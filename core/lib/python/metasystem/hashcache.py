@@ -0,0 +1,189 @@
+"""
+This module caches digests of file contents.  Each digest is stored with the
+inode number, size and mtime of the file from which it was computed, and is
+reused for as long as those are unchanged, so that unmodified files are not
+read again.
+"""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from metasystem import snapshot
+
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+ALGORITHM = 'sha1'
+
+_READ_SIZE = 1024 * 1024
+
+# A file whose mtime is this close to the time at which it was read may be
+# modified again without its mtime changing, so its digest is not cached
+_RACY_WINDOW = 2 * 1000000000
+
+
+#------------------------------------------------------------------------------
+# Public functions
+#------------------------------------------------------------------------------
+
+def file_digest(filename, algorithm=ALGORITHM):
+    """
+    Returns the hex digest of the contents of a file.
+    """
+
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        while True:
+            buf = f.read(_READ_SIZE)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def entry_key(entry):
+    """
+    Returns the (inode, size, mtime) key of a Snapshot entry.
+    """
+
+    return (entry[3], entry[1], entry[2])
+
+
+#------------------------------------------------------------------------------
+# HashCache
+#------------------------------------------------------------------------------
+
+class HashCache(object):
+    """
+    Maps the path of each file under a root directory, relative to that root,
+    to an (inode, size, mtime, digest) tuple.  mtime is in nanoseconds.
+    hashed and hashed_bytes count the files which have been read since the
+    cache was created or loaded.
+    """
+
+    def __init__(self, entries=None, algorithm=ALGORITHM):
+
+        self.entries = entries or {}
+        self.algorithm = algorithm
+        self.hashed = 0
+        self.hashed_bytes = 0
+
+
+    def get(self, path, key):
+        """
+        Returns the cached digest of path, or None if there is none or if
+        key, an (inode, size, mtime) tuple, does not match.
+        """
+
+        cached = self.entries.get(path)
+        if cached is not None and cached[:3] == tuple(key):
+            return cached[3]
+        return None
+
+
+    def set(self, path, key, digest):
+
+        if time.time() * 1000000000 - key[2] < _RACY_WINDOW:
+            self.entries.pop(path, None)
+        else:
+            self.entries[path] = tuple(key) + (digest,)
+
+
+    def stale(self, keys):
+        """
+        Returns the paths, from a dict which maps paths to (inode, size,
+        mtime) tuples, whose digests are not cached.
+        """
+
+        return sorted([path for path, key in keys.items()
+                       if self.get(path, key) is None])
+
+
+    def prune(self, paths):
+        """
+        Removes the entries for all paths except those given.
+        """
+
+        paths = set(paths)
+        for path in list(self.entries.keys()):
+            if path not in paths:
+                del self.entries[path]
+
+
+    def digest(self, path, filename, key):
+        """
+        Returns the digest of the file at filename, whose path relative to
+        the root is path, reading it only if the cached digest is stale.
+        """
+
+        digest = self.get(path, key)
+        if digest is None:
+            digest = file_digest(filename, self.algorithm)
+            self.set(path, key, digest)
+            self.hashed += 1
+            self.hashed_bytes += key[1]
+        return digest
+
+
+    def digests(self, root, current=None):
+        """
+        Returns a dict which maps the path of each file under root to its
+        digest.  current is a Snapshot of root; if it is not given, root is
+        scanned.  Entries for files which no longer exist are removed.
+        """
+
+        if current is None:
+            current = snapshot.scan(root)
+        result = {}
+        for path, entry in current.entries.items():
+            if entry[0] != snapshot._FILE:
+                continue
+            result[path] = self.digest(path, os.path.join(root, path), entry_key(entry))
+        self.prune(result.keys())
+        return result
+
+
+def load(filename, algorithm=ALGORITHM):
+    """
+    Returns the HashCache stored in filename.  If it cannot be read, or was
+    computed with a different algorithm, an empty HashCache is returned.
+    """
+
+    try:
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        if data['algorithm'] == algorithm:
+            return HashCache(data['entries'], algorithm)
+    except Exception:
+        pass
+    return HashCache(algorithm=algorithm)
+
+
+def save(cache, filename):
+    """
+    Stores a HashCache.  The file is replaced atomically, so that a reader
+    never sees a partially written cache.
+    """
+
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp = filename + '.tmp.' + str(os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump({'algorithm': cache.algorithm, 'entries': cache.entries},
+                    f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
@@ -0,0 +1,174 @@
+"""
+This module provides snapshots of directory trees.  Comparing two snapshots of
+the same tree shows which files were modified in between, without reading the
+contents of any file.
+"""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import os
+import stat
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+_DIR = 'd'
+_FILE = 'f'
+_LINK = 'l'
+# FIFOs, sockets and device nodes
+_SPECIAL = 's'
+
+
+#------------------------------------------------------------------------------
+# Snapshot
+#------------------------------------------------------------------------------
+
+class Snapshot(object):
+    """
+    Maps the path of each entry under a root directory, relative to that root,
+    to a (type, size, mtime, inode) tuple.  type is one of _DIR, _FILE (a
+    regular file), _LINK or _SPECIAL.
+    """
+
+    def __init__(self, entries=None):
+
+        self.entries = entries or {}
+
+
+    def __eq__(self, other):
+
+        return other is not None and self.entries == other.entries
+
+
+    def __ne__(self, other):
+
+        return not self.__eq__(other)
+
+
+    def changed(self, previous):
+        """
+        Returns the paths of files and links which are new or modified since
+        the previous snapshot, and of directories which are new.
+        """
+
+        result = []
+        for path, entry in self.entries.items():
+            old = previous.entries.get(path)
+            if old is None or (entry[0] != _DIR and old != entry):
+                result.append(path)
+        return sorted(result)
+
+
+    def deleted(self, previous):
+        """
+        Returns the paths which are present in the previous snapshot but not
+        in this one.
+        """
+
+        return sorted(set(previous.entries.keys()) - set(self.entries.keys()))
+
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+
+def _entry(st):
+
+    if stat.S_ISDIR(st.st_mode):
+        kind = _DIR
+    elif stat.S_ISLNK(st.st_mode):
+        kind = _LINK
+    elif stat.S_ISREG(st.st_mode):
+        kind = _FILE
+    else:
+        kind = _SPECIAL
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1000000000)
+    size = st.st_size
+    if kind == _DIR:
+        # Directory sizes depend on the file system, and carry no information
+        size = 0
+    return (kind, size, mtime, st.st_ino)
+
+
+def _list(path):
+    """
+    Yields a (name, stat) tuple for each entry in a directory, without
+    following symlinks.
+    """
+
+    if scandir:
+        for entry in scandir(path):
+            yield (entry.name, entry.stat(follow_symlinks=False))
+    else:
+        for name in os.listdir(path):
+            yield (name, os.lstat(os.path.join(path, name)))
+
+
+def scan(root, exclude=None):
+    """
+    Returns a Snapshot of the tree under root.  Names listed in exclude are
+    skipped at every level of the tree.
+    """
+
+    exclude = set(exclude or [])
+    entries = {}
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        for name, st in _list(os.path.join(root, rel)):
+            if name in exclude:
+                continue
+            path = os.path.join(rel, name)
+            entry = _entry(st)
+            entries[path] = entry
+            if entry[0] == _DIR:
+                stack.append(path)
+    return Snapshot(entries)
+
+
+def load(filename):
+    """
+    Returns the Snapshot stored in filename, or None if it cannot be read.
+    """
+
+    try:
+        with open(filename, 'rb') as f:
+            return Snapshot(pickle.load(f))
+    except Exception:
+        return None
+
+
+def save(snapshot, filename):
+    """
+    Stores a Snapshot.  The file is replaced atomically, so that a reader
+    never sees a partially written snapshot.
+    """
+
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp = filename + '.tmp.' + str(os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(snapshot.entries, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+
+# Script for comparing the delta module against rsync, for trees on the local
+# file system
+#
+# Usage: delta-benchmark.py [files] [size in KiB]
+
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(sys.path[0], '../lib/python'))
+from metasystem import delta
+
+def make_tree(root, files, size):
+    rng = random.Random(0)
+    for i in range(files):
+        dirname = os.path.join(root, 'd' + str(i % 10))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'f' + str(i)), 'wb') as f:
+            f.write(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+def modify_tree(root, files):
+    # Overwrite a few bytes in the middle of every tenth file
+    for i in range(0, files, 10):
+        path = os.path.join(root, 'd' + str(i % 10), 'f' + str(i))
+        with open(path, 'r+b') as f:
+            f.seek(os.path.getsize(path) // 2)
+            f.write(b'modified')
+
+def native(src, dst):
+    delta.sync_tree(src, dst, delete=True)
+
+def rsync(src, dst):
+    subprocess.check_call(['rsync', '-a', '--delete', src + '/', dst])
+
+def timed(func, src, dst):
+    start = time.time()
+    func(src, dst)
+    return time.time() - start
+
+def have_rsync():
+    with open(os.devnull, 'w') as null:
+        try:
+            return subprocess.call(['rsync', '--version'], stdout=null) == 0
+        except OSError:
+            return False
+
+files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+size = (int(sys.argv[2]) if len(sys.argv) > 2 else 256) * 1024
+
+engines = [('native', native)]
+if have_rsync():
+    engines.append(('rsync', rsync))
+else:
+    print("rsync not found; timing native engine only")
+
+work = tempfile.mkdtemp(prefix='delta-benchmark-')
+try:
+    src = os.path.join(work, 'src')
+    make_tree(src, files, size)
+    print(str(files) + ' files of ' + str(size // 1024) + ' KiB')
+    print('%-10s %10s %10s %10s' % ('engine', 'initial', 'resync', 'modified'))
+    results = dict((name, []) for (name, func) in engines)
+    for (name, func) in engines:
+        dst = os.path.join(work, name)
+        results[name].append(timed(func, src, dst))
+        results[name].append(timed(func, src, dst))
+    # Both engines see the same modification
+    modify_tree(src, files)
+    for (name, func) in engines:
+        dst = os.path.join(work, name)
+        results[name].append(timed(func, src, dst))
+    for (name, func) in engines:
+        print('%-10s %9.3fs %9.3fs %9.3fs' % tuple([name] + results[name]))
+finally:
+    shutil.rmtree(work)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+
+# Script for checking the behaviour of the delta module
+#
+# Each check builds source and destination trees in a temporary directory,
+# runs delta.sync_tree, and then inspects the result.
+#
+# Usage: delta-checks.py [checks ...]
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.append(os.path.join(sys.path[0], '../lib/python'))
+from metasystem import delta
+
+class Workspace:
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='delta-checks-')
+        self.src = os.path.join(self.dir, 'src')
+        self.dst = os.path.join(self.dir, 'dst')
+        os.makedirs(self.src)
+
+    def write(self, root, name, content, mtime=None):
+        path = os.path.join(root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def read(self, root, name):
+        with open(os.path.join(root, name), 'rb') as f:
+            return f.read()
+
+    def tree(self, root):
+        # Returns the sorted paths under root
+        result = []
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            for name in dirnames + filenames:
+                result.append(os.path.relpath(os.path.join(dirpath, name), root))
+        return sorted(result)
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+#------------------------------------------------------------------------------
+# Checks
+#------------------------------------------------------------------------------
+
+def check_copy(ws):
+    ws.write(ws.src, 'a', 'a')
+    ws.write(ws.src, 'd/b', 'b' * 100000)
+    os.symlink('a', os.path.join(ws.src, 'l'))
+    stats = delta.sync_tree(ws.src, ws.dst)
+    if ws.tree(ws.dst) != ['a', 'd', 'd/b', 'l']:
+        return 'destination has ' + ' '.join(ws.tree(ws.dst))
+    if ws.read(ws.dst, 'd/b') != 'b' * 100000 or os.readlink(os.path.join(ws.dst, 'l')) != 'a':
+        return 'destination differs from source'
+    if stats.bytes != 100001:
+        return str(stats.bytes) + ' bytes reported'
+    if delta.sync_tree(ws.src, ws.dst).files:
+        return 'unchanged files were transferred again'
+    return None
+
+def check_replace(ws):
+    # Updated files replace the destination, so other links to it and its
+    # permissions do not matter
+    ws.write(ws.src, 'a', 'x' * (3 * delta.BLOCK_SIZE), mtime=1000)
+    delta.sync_tree(ws.src, ws.dst)
+    link = os.path.join(ws.dir, 'link')
+    os.link(os.path.join(ws.dst, 'a'), link)
+    os.chmod(os.path.join(ws.dst, 'a'), 0444)
+    ws.write(ws.src, 'a', 'y' * (3 * delta.BLOCK_SIZE), mtime=2000)
+    delta.sync_tree(ws.src, ws.dst)
+    if ws.read(ws.dst, 'a') != 'y' * (3 * delta.BLOCK_SIZE):
+        return 'destination was not updated'
+    if ws.read(ws.dir, 'link') != 'x' * (3 * delta.BLOCK_SIZE):
+        return 'hard link to the destination was modified'
+    if os.stat(os.path.join(ws.dst, 'a')).st_mtime != 2000:
+        return 'mtime was not copied'
+    if ws.tree(ws.dst) != ['a']:
+        return 'destination has ' + ' '.join(ws.tree(ws.dst))
+    return None
+
+def check_inplace(ws):
+    ws.write(ws.src, 'a', 'x' * (3 * delta.BLOCK_SIZE), mtime=1000)
+    delta.sync_tree(ws.src, ws.dst)
+    link = os.path.join(ws.dir, 'link')
+    os.link(os.path.join(ws.dst, 'a'), link)
+    content = 'x' * delta.BLOCK_SIZE + 'y' * 10
+    ws.write(ws.src, 'a', content, mtime=2000)
+    stats = delta.sync_tree(ws.src, ws.dst, inplace=True)
+    if ws.read(ws.dir, 'link') != content:
+        return 'destination was not updated in place'
+    if stats.bytes != 10:
+        return str(stats.bytes) + ' bytes written'
+    return None
+
+def check_checksum(ws):
+    # Files whose size and mtime match are only transferred if they differ
+    ws.write(ws.src, 'same', 'a' * 1000, mtime=1000)
+    ws.write(ws.src, 'other', 'b' * 1000, mtime=1000)
+    delta.sync_tree(ws.src, ws.dst)
+    ws.write(ws.dst, 'other', 'c' * 1000, mtime=1000)
+    if delta.sync_tree(ws.src, ws.dst).files:
+        return 'files with matching size and mtime were transferred'
+    stats = delta.sync_tree(ws.src, ws.dst, checksum=True)
+    if stats.paths != ['other']:
+        return 'transferred ' + ' '.join(stats.paths)
+    if ws.read(ws.dst, 'other') != 'b' * 1000:
+        return 'destination was not updated'
+    return None
+
+def check_paths(ws):
+    # Only the given paths are transferred, and nothing is deleted
+    ws.write(ws.src, 'a', 'a')
+    ws.write(ws.src, 'd/b', 'b')
+    ws.write(ws.dst, 'c', 'c')
+    stats = delta.sync_tree(ws.src, ws.dst, paths=['d/b'], delete=True)
+    if ws.tree(ws.dst) != ['c', 'd', 'd/b']:
+        return 'destination has ' + ' '.join(ws.tree(ws.dst))
+    delta.sync_tree(ws.src, ws.dst, delete=True)
+    if ws.tree(ws.dst) != ['a', 'd', 'd/b']:
+        return 'destination has ' + ' '.join(ws.tree(ws.dst))
+    return None
+
+def check_dry_run(ws):
+    ws.write(ws.src, 'a', 'a')
+    ws.write(ws.dst, 'b', 'b')
+    stats = delta.sync_tree(ws.src, ws.dst, delete=True, dry_run=True)
+    if stats.paths != ['a', 'deleting b']:
+        return 'listed ' + ' '.join(stats.paths)
+    if ws.tree(ws.dst) != ['b']:
+        return 'destination was modified'
+    return None
+
+def check_special(ws):
+    # Special files are skipped, rather than opened
+    os.mkfifo(os.path.join(ws.src, 'fifo'))
+    ws.write(ws.src, 'a', 'a')
+    stats = delta.sync_tree(ws.src, ws.dst)
+    if stats.skipped != ['fifo'] or ws.tree(ws.dst) != ['a']:
+        return 'destination has ' + ' '.join(ws.tree(ws.dst))
+    return None
+
+Checks = [
+    ('copy', check_copy),
+    ('replace', check_replace),
+    ('inplace', check_inplace),
+    ('checksum', check_checksum),
+    ('paths', check_paths),
+    ('dry-run', check_dry_run),
+    ('special', check_special)
+]
+
+names = sys.argv[1:] or [name for (name, func) in Checks]
+failed = 0
+for (name, func) in Checks:
+    if not name in names:
+        continue
+    ws = Workspace()
+    try:
+        error = func(ws)
+    finally:
+        ws.remove()
+    if error:
+        failed += 1
+        print('%-20s FAIL: %s' % (name, error))
+    else:
+        print('%-20s ok' % name)
+sys.exit(1 if failed else 0)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python2
+
+# Script for benchmarking metasystem-sync.py against synthetic projects
+#
+# Generates synthetic git, rsync and unison projects, whose remotes are
+# directories on the local file system or, with --ssh, on localhost via sshd.
+# Then runs init, status and sync with each --jobs setting, and reports for
+# each run the wall time, the CPU time used by metasystem-sync.py and its
+# children, and the number of processes started for each tool.  Processes
+# are counted by shims which are placed ahead of the real tools on PATH.
+#
+# Without --ssh, rsync projects use 'engine = native', since the script only
+# runs rsync against remote hosts.
+#
+# Usage: sync-benchmark.py [options]
+
+from __future__ import print_function
+
+from distutils.spawn import find_executable
+from optparse import OptionParser
+import os
+import pty
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+Script = os.path.join(sys.path[0], '../bin/metasystem-sync.py')
+
+Tools = ['git', 'rsync', 'unison', 'ssh']
+
+GitEnv = {
+    'GIT_AUTHOR_NAME': 'benchmark',
+    'GIT_AUTHOR_EMAIL': 'benchmark@localhost',
+    'GIT_COMMITTER_NAME': 'benchmark',
+    'GIT_COMMITTER_EMAIL': 'benchmark@localhost'
+}
+
+def parse_args():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--projects', type='int', default=20,
+                      help='Number of projects of each type (default 20)')
+    parser.add_option('--files', type='int', default=50,
+                      help='Number of files in each project (default 50)')
+    parser.add_option('--types', default='git,rsync,unison',
+                      help='Project types (default git,rsync,unison)')
+    parser.add_option('-j', '--jobs', default='1,4,16',
+                      help='Comma-separated --jobs settings (default 1,4,16)')
+    parser.add_option('--ssh', action='store_true', default=False,
+                      help='Access remotes via ssh to localhost')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help='Do not delete the work directory')
+    (options, args) = parser.parse_args()
+    options.types = options.types.split(',')
+    options.jobs = [int(x) for x in options.jobs.split(',')]
+    return options
+
+def write_files(root, count, tag):
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    for i in range(count):
+        with open(os.path.join(root, 'f%03d' % i), 'w') as f:
+            f.write(('%s %d\n' % (tag, i)) * 100)
+
+def call(args, cwd=None, env=None):
+    with open(os.devnull, 'w') as null:
+        subprocess.check_call(args, cwd=cwd, env=env, stdout=null, stderr=null)
+
+class Workspace:
+    def __init__(self, options):
+        self.options = options
+        self.dir = tempfile.mkdtemp(prefix='sync-benchmark-')
+        self.home = os.path.join(self.dir, 'home')
+        self.local = os.path.join(self.dir, 'local')
+        self.remote = os.path.join(self.dir, 'remote')
+        self.shims = os.path.join(self.dir, 'shims')
+        self.countFile = os.path.join(self.dir, 'processes.log')
+        self.ini = os.path.join(self.dir, 'sync.ini')
+        self.projects = []
+        os.makedirs(self.home)
+        self.env = dict(os.environ)
+        self.env.update(GitEnv)
+        self.env['HOME'] = self.home
+        self.env['METASYSTEM_CORE_CONFIG'] = self.dir
+
+    def make_shims(self):
+        # Each shim records its name and then runs the real tool
+        os.makedirs(self.shims)
+        for tool in Tools:
+            real = find_executable(tool)
+            if not real:
+                continue
+            path = os.path.join(self.shims, tool)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\necho %s >> %s\nexec %s "$@"\n' % (tool, self.countFile, real))
+            os.chmod(path, 0755)
+        self.env['PATH'] = self.shims + os.pathsep + os.environ['PATH']
+
+    def make_projects(self):
+        for type in self.options.types:
+            # The native engine does not need rsync
+            tool = None if type == 'rsync' and not self.options.ssh else type
+            if tool and not find_executable(tool):
+                print("'" + tool + "' not found; skipping " + type + " projects")
+                continue
+            for i in range(self.options.projects):
+                name = '%s%03d' % (type, i)
+                path = os.path.join(self.remote, type, name)
+                if type == 'git':
+                    work = os.path.join(self.dir, 'tmp', name)
+                    write_files(work, self.options.files, name)
+                    call(['git', 'init', '-q'], cwd=work)
+                    call(['git', 'add', '.'], cwd=work)
+                    call(['git', 'commit', '-q', '-m', 'Initial'], cwd=work, env=self.env)
+                    call(['git', 'clone', '-q', '--bare', work, path + '.git'])
+                    shutil.rmtree(work)
+                else:
+                    write_files(path, self.options.files, name)
+                self.projects.append((name, type))
+
+    def remote_root(self, type):
+        if not self.options.ssh:
+            return self.remote
+        if type == 'rsync':
+            return 'localhost'
+        # ssh://host//path is absolute for unison, but not for git
+        if type == 'unison':
+            return 'ssh://localhost/' + self.remote
+        return 'ssh://localhost' + self.remote
+
+    def write_ini(self):
+        with open(self.ini, 'w') as f:
+            f.write('[local:bench]\nhostname = %s\nroot = %s\n\n' % (socket.gethostname(), self.local))
+            for type in self.options.types:
+                f.write('[remote:%s]\nroot = %s\nmax_jobs = 1000\n' % (type, self.remote_root(type)))
+                if type == 'rsync' and not self.options.ssh:
+                    f.write('engine = native\n')
+                f.write('\n')
+            for (name, type) in self.projects:
+                remote_path = os.path.join(type, name)
+                if type == 'rsync' and self.options.ssh:
+                    remote_path = os.path.join(self.remote, remote_path)
+                f.write('[project:%s]\ntype = %s\nauto = true\nlocal_path = %s\n'
+                        'default_remote = %s\nremote_path = %s\n\n' %
+                        (name, type, os.path.join(type, name), type, remote_path))
+
+    def modify(self, fraction):
+        # Changes one file in a fraction of the local projects
+        step = max(1, int(1 / fraction))
+        for (name, type) in self.projects[::step]:
+            path = os.path.join(self.local, type, name)
+            with open(os.path.join(path, 'f000'), 'a') as f:
+                f.write('modified %f\n' % time.time())
+            if type == 'git':
+                call(['git', 'commit', '-q', '-a', '-m', 'Modified'], cwd=path, env=self.env)
+
+    def reset(self):
+        # Returns the workspace to its state before the first init
+        shutil.rmtree(self.local, ignore_errors=True)
+        shutil.rmtree(self.home, ignore_errors=True)
+        os.makedirs(self.home)
+
+    def process_counts(self):
+        counts = dict((tool, 0) for tool in Tools)
+        if os.path.exists(self.countFile):
+            with open(self.countFile) as f:
+                for line in f:
+                    counts[line.strip()] += 1
+        return counts
+
+    def run(self, args):
+        # The script's console module requires a terminal on standard input
+        (master, slave) = pty.openpty()
+        before = self.process_counts()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        with open(os.devnull, 'w') as null:
+            code = subprocess.call([sys.executable, Script] + args + ['-i', self.ini],
+                                   stdin=slave, stdout=null, stderr=null, env=self.env)
+        wall = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        os.close(slave)
+        os.close(master)
+        cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+        counts = self.process_counts()
+        processes = dict((tool, counts[tool] - before[tool]) for tool in Tools)
+        return (code, wall, cpu, processes)
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def report(scenario, jobs, result):
+    (code, wall, cpu, processes) = result
+    status = 'ok' if code == 0 else 'exit %d' % code
+    print('%-16s %5d %9.2fs %9.2fs %s %s' %
+          (scenario, jobs, wall, cpu,
+           ' '.join(['%6d' % processes[tool] for tool in Tools]), status))
+
+options = parse_args()
+workspace = Workspace(options)
+try:
+    workspace.make_shims()
+    workspace.make_projects()
+    workspace.write_ini()
+    print(str(len(workspace.projects)) + ' projects of ' + str(options.files) +
+          ' files in ' + workspace.dir)
+    print('%-16s %5s %10s %10s %s' % ('scenario', 'jobs', 'wall', 'cpu',
+                                      ' '.join(['%6s' % tool for tool in Tools])))
+    for jobs in options.jobs:
+        workspace.reset()
+        j = ['-j', str(jobs)]
+        report('init', jobs, workspace.run(['init'] + j))
+        report('status', jobs, workspace.run(['status'] + j))
+        report('sync', jobs, workspace.run(['sync'] + j))
+        report('sync (no change)', jobs, workspace.run(['sync'] + j))
+        workspace.modify(0.1)
+        report('sync (modified)', jobs, workspace.run(['sync'] + j))
+        report('sync --force', jobs, workspace.run(['sync', '--force'] + j))
+finally:
+    if options.keep:
+        print('Work directory: ' + workspace.dir)
+    else:
+        workspace.remove()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python2
+
+# Script for checking the behaviour of metasystem-sync.py
+#
+# Each check runs metasystem-sync.py against projects and remotes in a
+# temporary directory, and then inspects the result.  Remotes are local
+# directories, and rsync projects use 'engine = native', so only git is
+# required.
+#
+# Usage: sync-checks.py [checks ...]
+
+from __future__ import print_function
+
+import json
+import os
+import pty
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+Script = os.path.join(sys.path[0], '../bin/metasystem-sync.py')
+
+Git = ['git', '-c', 'user.name=check', '-c', 'user.email=check@localhost']
+
+class Workspace:
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='sync-checks-')
+        self.home = os.path.join(self.dir, 'home')
+        self.local = os.path.join(self.dir, 'local')
+        self.ini = os.path.join(self.dir, 'sync.ini')
+        os.makedirs(self.home)
+        os.makedirs(self.local)
+        self.env = dict(os.environ)
+        self.env['HOME'] = self.home
+        self.env['METASYSTEM_CORE_CONFIG'] = self.dir
+        self.sections = '[local:check]\nhostname = %s\nroot = %s\n\n' % \
+                        (socket.gethostname(), self.local)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def add(self, section, **fields):
+        self.sections += '[' + section + ']\n'
+        for key in sorted(fields.keys()):
+            self.sections += key + ' = ' + str(fields[key]) + '\n'
+        self.sections += '\n'
+
+    def write(self, name, content):
+        path = os.path.join(self.local, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def run(self, args):
+        # Returns the exit code and standard output.  The script's console
+        # module requires a terminal on standard input.
+        with open(self.ini, 'w') as f:
+            f.write(self.sections)
+        (master, slave) = pty.openpty()
+        with open(os.devnull, 'w') as null:
+            process = subprocess.Popen([sys.executable, Script] + args + ['-i', self.ini],
+                                       stdin=slave, stdout=subprocess.PIPE, stderr=null,
+                                       env=self.env)
+            output = process.communicate()[0]
+        os.close(slave)
+        os.close(master)
+        return (process.returncode, output)
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def call(args, cwd=None):
+    with open(os.devnull, 'w') as null:
+        subprocess.check_call(args, cwd=cwd, stdout=null, stderr=null)
+
+def make_repo(ws, name):
+    # Creates a bare repository under remote/ with one commit
+    path = ws.path('remote', name + '.git')
+    seed = ws.path('seed-' + name)
+    call(Git + ['init', '-q', '--bare', path])
+    call(Git + ['clone', '-q', path, seed])
+    with open(os.path.join(seed, 'f'), 'w') as f:
+        f.write('1')
+    call(Git + ['add', 'f'], cwd=seed)
+    call(Git + ['commit', '-q', '-m', 'First'], cwd=seed)
+    call(Git + ['push', '-q', 'origin', 'HEAD:master'], cwd=seed)
+    shutil.rmtree(seed)
+
+#------------------------------------------------------------------------------
+# Checks
+#------------------------------------------------------------------------------
+
+def check_switch_remote(ws):
+    # A push-only project's snapshot records what was sent to one remote, so
+    # it must not cause files to be skipped when pushing to another
+    for name in ('n', 'n2'):
+        os.makedirs(ws.path(name))
+        ws.add('remote:' + name, root=ws.path(name), engine='native')
+    ws.add('project:out', type='rsync', local_path='out', default_remote='n',
+           remote_path='out', direction='push')
+    ws.write('out/a', 'a')
+    ws.write('out/b', 'b')
+    ws.run(['sync', 'out'])
+    ws.run(['sync', 'out', '-r', 'n2'])
+    ws.write('out/c', 'c')
+    ws.run(['sync', 'out', '-r', 'n2'])
+    ws.run(['sync', 'out'])
+    for name in ('n', 'n2'):
+        present = sorted(os.listdir(ws.path(name, 'out')))
+        if present != ['a', 'b', 'c']:
+            return "remote '" + name + "' has " + ' '.join(present)
+    return None
+
+def check_requires_refs(ws):
+    # A project which follows another that pushed to the same repository
+    # must not be skipped on the strength of refs listed before that push
+    make_repo(ws, 'repo')
+    for name in ('up', 'down'):
+        call(Git + ['clone', '-q', ws.path('remote', 'repo.git'), os.path.join(ws.local, name)])
+    ws.add('remote:r', root=ws.path('remote'))
+    ws.add('project:up', type='git', local_path='up', default_remote='r',
+           remote_path='repo', direction='push')
+    ws.add('project:down', type='git', local_path='down', default_remote='r',
+           remote_path='repo', direction='pull')
+    ws.add('project-group:g', projects='up down', requires='down:up')
+    ws.write('up/f', '2')
+    call(Git + ['commit', '-q', '-a', '-m', 'Second'], cwd=os.path.join(ws.local, 'up'))
+    ws.run(['sync', 'g'])
+    with open(os.path.join(ws.local, 'down', 'f')) as f:
+        if f.read() != '2':
+            return "project 'down' was not updated"
+    return None
+
+def check_json_output(ws):
+    # With --format json, output of the commands run by the script must not
+    # be mixed into the document
+    make_repo(ws, 'repo')
+    call(Git + ['clone', '-q', ws.path('remote', 'repo.git'), os.path.join(ws.local, 'p')])
+    ws.add('remote:r', root=ws.path('remote'))
+    ws.add('project:p', type='git', local_path='p', default_remote='r', remote_path='repo')
+    for action in (['sync', '--force'], ['status'], ['list']):
+        (code, output) = ws.run(action + ['--format', 'json'])
+        try:
+            json.loads(output)
+        except ValueError:
+            return "'" + ' '.join(action) + "' printed " + repr(output[:60])
+    return None
+
+def check_legacy_history(ws):
+    # Operations imported from ~/.sync-history have no duration
+    with open(os.path.join(ws.home, '.sync-history'), 'w') as f:
+        f.write('sync 1700000000 1700000000\n')
+        f.write('p 1700000000 1700000000 1700000000 1690000000\n')
+    os.makedirs(ws.path('remote'))
+    ws.add('remote:r', root=ws.path('remote'), engine='native')
+    ws.add('project:p', type='rsync', local_path='p', default_remote='r', remote_path='p')
+    (code, output) = ws.run(['history'])
+    if code != 0:
+        return "'history' exited with " + str(code)
+    return None
+
+def check_resume(ws):
+    # --resume only skips projects which an interrupted run with the same
+    # remote and selection completed, and not while that run is in progress
+    for name in ('n', 'n2'):
+        os.makedirs(ws.path(name))
+        ws.add('remote:' + name, root=ws.path(name), engine='native')
+    for name in ('a', 'b'):
+        ws.add('project:' + name, type='rsync', local_path=name, default_remote='n',
+               remote_path=name)
+        ws.write(name + '/f', name)
+    ws.run(['sync', 'a', 'b'])
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    database = sqlite3.connect(os.path.join(ws.home, '.sync-history.db'))
+    with database:
+        database.execute('UPDATE runs SET end = NULL, pid = ?', (exited.pid,))
+    ws.run(['sync', 'a', 'b', '-r', 'n2', '--resume'])
+    present = sorted(os.listdir(ws.path('n2')))
+    if present != ['a', 'b']:
+        return "remote 'n2' has " + ' '.join(present)
+    (code, output) = ws.run(['sync', 'a', 'b', '--resume', '--format', 'json'])
+    projects = json.loads(output)['projects']
+    if not projects['a'].get('resumed') or not projects['b'].get('resumed'):
+        return 'interrupted run was not resumed'
+    with database:
+        database.execute('UPDATE runs SET end = NULL, pid = ?', (os.getpid(),))
+    (code, output) = ws.run(['sync', 'a', 'b', '--resume'])
+    if code == 0:
+        return 'resumed a run which is in progress'
+    return None
+
+Checks = [
+    ('switch-remote', check_switch_remote),
+    ('requires-refs', check_requires_refs),
+    ('json-output', check_json_output),
+    ('legacy-history', check_legacy_history),
+    ('resume', check_resume)
+]
+
+names = sys.argv[1:] or [name for (name, func) in Checks]
+failed = 0
+for (name, func) in Checks:
+    if not name in names:
+        continue
+    ws = Workspace()
+    try:
+        error = func(ws)
+    finally:
+        ws.remove()
+    if error:
+        failed += 1
+        print('%-20s FAIL: %s' % (name, error))
+    else:
+        print('%-20s ok' % name)
+sys.exit(1 if failed else 0)
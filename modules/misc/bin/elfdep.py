@@ -64,6 +64,12 @@ libaudioeffect_jni.so
 
 $ elfdep.py libmedia.so --graph out.png
 
+The dynamic section of each file is read directly, by mapping the file into
+memory, rather than by running readelf.  Each file is read at most once, so a
+directory containing thousands of libraries can be scanned in seconds.  Both
+32- and 64-bit files, of either byte order, are supported.  The --readelf
+option uses readelf instead.
+
 '''
 
 
@@ -75,7 +81,9 @@ from __future__ import print_function
 
 import argparse
 import logging
+import mmap
 import os.path
+import struct
 import subprocess
 import sys
 import tempfile
@@ -87,6 +95,24 @@ import tempfile
 
 LINE_WIDTH = 80
 
+ELF_MAGIC = '\x7fELF'
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
 
 #------------------------------------------------------------------------------
 # Classes
@@ -129,6 +155,138 @@ class ReadelfParser(object):
 
 
 
+class ElfDynamic(object):
+    '''
+    Contents of the dynamic section of an ELF file.
+    '''
+    def __init__(self):
+        self.soname = ''
+        self.needed = []
+        self.rpath = []
+        self.runpath = []
+
+
+class ElfParser(object):
+    '''
+    Class which parses ELF headers in-process.
+    The file is mapped into memory, and the program headers are used to locate
+    the dynamic section and its string table, so that only the pages which
+    contain them are read.  The results for each file are cached.
+    The accessor functions match those of ReadelfParser.
+    '''
+    def __init__(self):
+        self._cache = {}
+
+    def get_needed(self, path):
+        return self.get_dynamic(path).needed
+
+    def get_soname(self, path):
+        return self.get_dynamic(path).soname
+
+    def get_rpath(self, path):
+        return self.get_dynamic(path).rpath
+
+    def get_runpath(self, path):
+        return self.get_dynamic(path).runpath
+
+    def get_dynamic(self, path):
+        '''
+        Return: ElfDynamic, which is empty if path is not a dynamically
+        linked ELF file
+        '''
+        result = self._cache.get(path)
+        if result is None:
+            result = ElfDynamic()
+            try:
+                with open(path, 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        self._parse(data, result)
+                    finally:
+                        data.close()
+            except (EnvironmentError, ValueError, struct.error) as e:
+                # ValueError is raised when mapping an empty file
+                logging.debug("[ELF] {0}: {1}".format(path, e))
+            self._cache[path] = result
+        return result
+
+    def _parse(self, data, result):
+        if data[:4] != ELF_MAGIC:
+            return
+        elfclass = ord(data[4])
+        order = {ELFDATA2LSB: '<', ELFDATA2MSB: '>'}.get(ord(data[5]))
+        if order is None:
+            raise ValueError('unknown ELF byte order {0}'.format(ord(data[5])))
+        if elfclass == ELFCLASS32:
+            (phoff,) = struct.unpack_from(order + 'I', data, 28)
+            (phentsize, phnum) = struct.unpack_from(order + 'HH', data, 42)
+            # p_type, p_offset, p_vaddr, p_filesz
+            phdr = order + 'IIIxxxxI'
+            dyn = order + 'iI'
+        elif elfclass == ELFCLASS64:
+            (phoff,) = struct.unpack_from(order + 'Q', data, 32)
+            (phentsize, phnum) = struct.unpack_from(order + 'HH', data, 54)
+            # p_type, p_flags, p_offset, p_vaddr, p_filesz
+            phdr = order + 'IxxxxQQxxxxxxxxQ'
+            dyn = order + 'qQ'
+        else:
+            raise ValueError('unknown ELF class {0}'.format(elfclass))
+
+        loads = []
+        dynamic = None
+        for i in range(phnum):
+            (p_type, p_offset, p_vaddr, p_filesz) = \
+                struct.unpack_from(phdr, data, phoff + i * phentsize)
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+        if dynamic is None:
+            return
+
+        # Entries refer to strings by their offset in the string table, whose
+        # address is given by DT_STRTAB, which may follow them
+        entries = []
+        strtab = None
+        size = struct.calcsize(dyn)
+        (offset, filesz) = dynamic
+        for pos in range(offset, offset + filesz - size + 1, size):
+            (tag, value) = struct.unpack_from(dyn, data, pos)
+            if tag == DT_NULL:
+                break
+            if tag == DT_STRTAB:
+                strtab = self._file_offset(loads, value)
+            elif tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH):
+                entries.append((tag, value))
+        if strtab is None:
+            raise ValueError('DT_STRTAB not found in a loaded segment')
+
+        for (tag, value) in entries:
+            start = strtab + value
+            end = data.find('\0', start)
+            if end == -1:
+                raise ValueError('unterminated string in dynamic string table')
+            string = data[start:end]
+            if tag == DT_NEEDED:
+                result.needed.append(string)
+            elif tag == DT_SONAME:
+                result.soname = string
+            elif tag == DT_RPATH:
+                result.rpath += string.split(':')
+            else:
+                result.runpath += string.split(':')
+
+    def _file_offset(self, loads, address):
+        '''
+        Return: offset in the file of a virtual address, or None if it is
+        not in a loaded segment
+        '''
+        for (vaddr, offset, filesz) in loads:
+            if vaddr <= address < vaddr + filesz:
+                return offset + address - vaddr
+        return None
+
+
 class DependencyResolver(object):
     '''
     Class which attempts to resolve a list of dependencies by searching a list
@@ -139,9 +297,9 @@ class DependencyResolver(object):
             self.resolved = []
             self.unresolved = []
 
-    def __init__(self):
+    def __init__(self, parser=None):
         self._paths = []
-        self._parser = ReadelfParser()
+        self._parser = parser or ElfParser()
         self._sonames = {}
         pass
 
@@ -214,9 +372,9 @@ class DependencyTreeBuilder(object):
     Class which uses DependencyResolver to recursively build up a dependency
     graph for a given ELF file.
     '''
-    def __init__(self):
+    def __init__(self, parser=None):
         self._store = NodeStore()
-        self._resolver = DependencyResolver()
+        self._resolver = DependencyResolver(parser)
 
     def store(self):
         return self._store
@@ -445,6 +603,10 @@ class ArgumentParser(argparse.ArgumentParser):
                           dest='dry_run', default=False,
                           action='store_true',
                           help='just show what would be done')
+        self.add_argument('--readelf',
+                          dest='readelf', default=False,
+                          action='store_true',
+                          help='parse ELF headers using readelf')
         self.add_argument('-r', '--reverse',
                           dest='reverse', default=False,
                           action='store_true',
@@ -590,7 +752,7 @@ if args.debug:
 
 assert_file_exists(args.filename)
 
-builder = DependencyTreeBuilder()
+builder = DependencyTreeBuilder(ReadelfParser() if args.readelf else None)
 
 if args.reverse:
     reverse_search(builder, args)